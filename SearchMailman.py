@@ -28,16 +28,50 @@ import gzip
 import StringIO
 import urllib
 import urllib2
+import urlparse
+import httplib
+import cookielib
+import socket
+import json
+import shutil
+import tempfile
+import mmap
+import marshal
+import array
+import email.parser
+import sre_parse
+import sre_constants
+import calendar
+import datetime
 import re
 import sys
 import mailbox
 import os
-import datetime
 import getopt
 import ssl
 import email.utils
 import timestring
 import subprocess
+import threading
+import Queue
+import collections
+import HTMLParser
+import shlex
+import csv
+import time
+import BaseHTTPServer
+import SocketServer
+import cProfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __patch_id = re.compile(
     r'^\[.*PATCH.* (?P<patch_num>[0-9]+)/([0-9]+).*] (?P<patch_subj>.*)')
@@ -46,38 +80,697 @@ accept_all_certs = False
 login_user = None
 login_pass = None
 opener = None
+opener_lock = threading.Lock()
+cookie_jar = None
+session_lock = threading.Lock()
+session_hosts = {}
+host_jobs = None
+host_slots = {}
+host_slots_lock = threading.Lock()
+# where warnings raised along a search go; --jsonl keeps stdout to records
+diagnostics = sys.stdout
+
+HTTP_TIMEOUT = 60
+
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+ZSTD_LEVEL = 10
+COPY_CHUNK_SIZE = 1 << 20
+SYNC_OVERLAP = 4096
+
+CACHE_JOURNAL = '.access'
+CACHE_CHECKPOINTS = '.checkpoints'
+CACHE_COOKIES = '.cookies'
+CHECKPOINT_VERSION = 1
+CACHE_SIDECARS = ('.meta', '.idx', '.terms', '.urls')
+CACHE_SIZE_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+COMMANDS = ('sync', 'cache', 'report')
+
+REPORT_MEASURES = ('messages', 'patches', 'series', 'latency')
+REPORT_KEYS = ('list', 'sender', 'year', 'month', 'week', 'weekday',
+               'hour')
+REPORT_FORMATS = ('csv', 'json')
+SINGLE_PATCH_RE = re.compile(r'^\[[^\]]*PATCH[^\]]*\]')
+WEEKDAY_NAMES = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+LOGIN_FORM_RE = re.compile(r'<input[^>]*type=["\']?password', re.I)
+
+INDEX_VERSION = 1
+INDEXED_FIELDS = ('from', 'subject', 'date', 'message-id', 'in-reply-to',
+                  'references')
+INDEX_ARRAYS = (('offsets', 'L'), ('lengths', 'L'), ('timestamps', 'd'))
+
+TERM_INDEX_VERSION = 3
+TERM_RE = re.compile(r'\w+')
+TERM_GRAM = 3
+
+URL_MAP_VERSION = 1
+MHONARC_LINK_RE = re.compile(
+    r'<a\s+name="[0-9]*"\s+href="(?P<url>msg[0-9]*\.html)">(?P<subject>.*?)'
+    r'</a>(?:</strong>)?,?\s?(?:<em>(?P<sender>[^<]*)</em>)?', re.I | re.S)
+PIPERMAIL_LINK_RE = re.compile(
+    r'<li><a\s+href="(?P<url>[0-9]+\.html)">(?P<subject>.*?)</a>'
+    r'<a\s+name="[0-9]*">[^<]*</a>\s*(?:<i>(?P<sender>.*?)</i>)?',
+    re.I | re.S)
+
+OUTPUT_BATCH_SIZE = 4 << 20
+OUTPUT_OPEN_FILES = 64
+EXEC_QUEUE_DEPTH = 64
+MATCH_QUEUE_DEPTH = 256
+EXEC_FRAMINGS = ('mbox', 'length')
+
+SERVER_REFRESH = 15 * 60
+SERVER_MATCH_LIMIT = 1000
+
+MONTH_NAMES = ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+               'august', 'september', 'october', 'november', 'december']
+ARCHIVE_DATE_SLACK = 16 * 24 * 60 * 60
+
+FILTER_COST_HEADER = 1
+FILTER_COST_DATE = 2
+FILTER_COST_REGEX = 4
+FILTER_COST_BODY = 16
+NO_BODY_PART = object()
+
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+STATS_STAGES = ('list', 'fetch', 'inflate', 'index', 'terms', 'match',
+                'output')
+
+
+class run_statistics(object):
+    # time, bytes and items per stage, and per archive, of one run
+    def __init__(self):
+        self._enabled = False
+        self._stages = {}
+        self._archives = collections.OrderedDict()
+        self._counters = collections.OrderedDict()
+        self._started = time.time()
+        self._profiler = None
+        self._profile_path = None
+        self._json_path = None
+        self._lock = threading.Lock()
+
+    def enable(self, json_path=None):
+        self._enabled = True
+        self._json_path = json_path
+
+    def profile(self, path):
+        self._profile_path = path
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def add(self, stage, seconds=0.0, nbytes=0, items=0, archive=None):
+        if not self._enabled:
+            return
+        with self._lock:
+            tables = [self._stages]
+            if archive is not None:
+                tables.append(self._archives.setdefault(archive, {}))
+            for table in tables:
+                totals = table.setdefault(stage, [0.0, 0, 0])
+                totals[0] += seconds
+                totals[1] += nbytes
+                totals[2] += items
+
+    def count(self, name, items=1):
+        if not self._enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + items
+
+    def report(self):
+        stages = [stage for stage in STATS_STAGES if stage in self._stages]
+        result = {'wall': time.time() - self._started,
+                  'stages': dict((stage, dict(zip(('seconds', 'bytes',
+                                                   'items'),
+                                                  self._stages[stage])))
+                                 for stage in stages),
+                  'archives': [dict([('archive', archive)] +
+                                    [(stage, dict(zip(('seconds', 'bytes',
+                                                       'items'),
+                                                      totals)))
+                                     for stage, totals in
+                                     found.iteritems()])
+                               for archive, found in
+                               self._archives.iteritems()],
+                  'counters': self._counters}
+        if self._json_path == '-':
+            json.dump(result, sys.stdout, indent=1)
+            print
+            return
+        if self._json_path is not None:
+            with open(self._json_path, 'w') as fileop:
+                json.dump(result, fileop, indent=1)
+            return
+
+        out = sys.stderr
+        out.write("%-10s %10s %12s %8s\n" % ('stage', 'seconds', 'bytes',
+                                              'items'))
+        for stage in stages:
+            seconds, nbytes, items = self._stages[stage]
+            out.write("%-10s %10.3f %12d %8d\n" % (stage, seconds, nbytes,
+                                                    items))
+        columns = [stage for stage in stages
+                   if [found for found in self._archives.itervalues()
+                       if stage in found]]
+        out.write("\n%-28s" % 'archive')
+        for stage in columns:
+            out.write(" %9s" % stage)
+        out.write("\n")
+        for archive, found in self._archives.iteritems():
+            out.write("%-28s" % archive)
+            for stage in columns:
+                out.write(" %9.3f" % found.get(stage, [0.0])[0])
+            out.write("\n")
+        out.write("\n")
+        for name, items in self._counters.iteritems():
+            out.write("%s: %d\n" % (name, items))
+        out.write("wall time: %.3fs\n" % result['wall'])
+
+    def finish(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self._profile_path)
+            self._profiler = None
+        if self._enabled:
+            self._enabled = False
+            self.report()
+
+
+run_stats = run_statistics()
+
+
+def stats_archive_name(url):
+    # what a fetched page is reported as: an archive by its file name, a
+    # page of an archive along with the volume it belongs to, and the
+    # list page by the name of the list
+    parts = urlparse.urlsplit(url).path.split('/')
+    if not parts[-1]:
+        return '/'.join(parts[-2:]) or '(index)'
+    if parts[-1].endswith('.html') and len(parts) > 1:
+        return '/'.join(parts[-2:])
+    return parts[-1]
+
+
+def mbox_split(buf, start=0):
+    # yield the (start, end) byte range of every message in an mbox buffer,
+    # beginning with the message found at or after start
+    if buf[start:start + 5] != 'From ':
+        start = buf.find('\nFrom ', start)
+        if start == -1:
+            return
+        start += 1
+
+    while True:
+        end = buf.find('\nFrom ', start)
+        if end == -1:
+            yield start, len(buf)
+            return
+        yield start, end + 1
+        start = end + 1
+
+
+class archived_message(object):
+    def __init__(self, mbx, start, end, headers_only=False):
+        self._mbx = mbx
+        self._start = start
+        self._end = end
+        self._headers_only = headers_only
+        self._message = None
+        self._headers = None
+
+    def offset(self):
+        return self._start
+
+    def length(self):
+        return self._end - self._start
+
+    def raw(self):
+        return self._mbx.raw(self._start, self._end)
+
+    def headers(self):
+        if self._message is not None:
+            return self._message
+        if self._headers is None:
+            from_line, sep, text = self.raw().partition('\n')
+            end = text.find('\n\n')
+            if end != -1:
+                text = text[:end + 1]
+            self._headers = email.parser.HeaderParser().parsestr(text)
+        return self._headers
+
+    def message(self):
+        if self._message is None:
+            from_line, sep, text = self.raw().partition('\n')
+            # the blank line in front of the next 'From ' is the separator
+            if text.endswith('\n\n'):
+                text = text[:-1]
+            self._message = mailbox.mboxMessage(text)
+            self._message.set_from(from_line[5:].strip())
+        return self._message
+
+    def __getitem__(self, name):
+        if self._headers_only:
+            return self.headers()[name]
+        return self.message()[name]
+
+    def __contains__(self, name):
+        if self._headers_only:
+            return name in self.headers()
+        return name in self.message()
+
+    def __str__(self):
+        return str(self.message())
+
+    def timestamp(self):
+        return None
 
+    def __getattr__(self, name):
+        return getattr(self.message(), name)
+
+
+class indexed_message(archived_message):
+    def __init__(self, mbx, index, position, headers_only=False):
+        start = index['offsets'][position]
+        archived_message.__init__(self, mbx, start,
+                                  start + index['lengths'][position],
+                                  headers_only)
+        self._index = index
+        self._position = position
+
+    def position(self):
+        return self._position
+
+    def timestamp(self):
+        # the Date header in UTC seconds, None when it could not be parsed
+        timestamp = self._index['timestamps'][self._position]
+        if timestamp != timestamp:
+            return None
+        return timestamp
+
+    def __getitem__(self, name):
+        column = self._index['headers'].get(name.lower())
+        if column is None:
+            return archived_message.__getitem__(self, name)
+        return column[self._position]
+
+
+class mmappedMbox(object):
+    def __init__(self, fs_converted_url, ArchiveUrl=None):
+        self._path = fs_converted_url
+        self._name = os.path.basename(fs_converted_url)
+        if ArchiveUrl is not None:
+            self._name = stats_archive_name(ArchiveUrl)
+        self._buf = None
+        self._index = None
+        self._terms = None
+        self._urls = None
+        self._lock = threading.Lock()
+
+    def buffer(self):
+        with self._lock:
+            if self._buf is None:
+                started = time.time()
+                try:
+                    self._buf = mmap_cached_archive(self._path)
+                except:
+                    print >>diagnostics, "Unable to open mailbox [%s]" % \
+                        self._path
+                    self._buf = ''
+                run_stats.add('inflate', time.time() - started,
+                              len(self._buf), 1,
+                              self._name)
+        return self._buf
+
+    def index(self):
+        if self._index is None:
+            started = time.time()
+            self._index = load_archive_index(self._path)
+            if self._index is None:
+                self._index = build_archive_index(self._path, self)
+            run_stats.add('index', time.time() - started, 0,
+                          len(self._index['offsets']),
+                          self._name)
+        return self._index
+
+    def raw(self, start, end):
+        return self.buffer()[start:end]
+
+    def itermessages(self, headers_only=False, start=0):
+        for start, end in mbox_split(self.buffer(), start):
+            yield archived_message(self, start, end, headers_only)
+
+    def urls(self, page_path):
+        if self._urls is None:
+            validator = archive_validator(page_path) + \
+                self.index()['validator']
+            self._urls = load_url_map(self._path, validator)
+            if self._urls is None:
+                self._urls = build_url_map(self._path, self, page_path,
+                                           validator)
+        return self._urls
+
+    def terms(self):
+        if self._terms is None:
+            validator = self.index()['validator']
+            started = time.time()
+            self._terms = load_term_index(self._path, validator)
+            if self._terms is None:
+                self._terms = build_term_index(self._path, self, validator)
+            run_stats.add('terms', time.time() - started, 0,
+                          len(self._terms['terms']),
+                          self._name)
+        return self._terms
+
+    def iterindexed(self, positions=None, headers_only=False):
+        index = self.index()
+        if positions is None:
+            positions = xrange(len(index['offsets']))
+        for position in positions:
+            yield indexed_message(self, index, position, headers_only)
+
+
+def term_index_filename(fs_converted_url):
+    return fs_converted_url + '.terms'
+
+
+def term_grams(word):
+    return set(word[start:start + TERM_GRAM]
+               for start in xrange(len(word) - TERM_GRAM + 1))
+
+
+def message_terms(text):
+    # every TERM_GRAM long window of every word, and the shorter words
+    # whole, so that any part of a word can be looked up
+    terms = set()
+    for word in set(TERM_RE.findall(text.lower())):
+        if len(word) <= TERM_GRAM:
+            terms.add(word)
+        else:
+            terms.update(term_grams(word))
+    return terms
 
-class streammedMbox(mailbox.mbox):
-    def __init__(self, stringOfBytes):
-        self._file = StringIO.StringIO(stringOfBytes)
-        self._toc = None
-        self._next_key = 0
-        self._pending = False
-        self._locked = False
-        self._file_length = None
-        self._factory = None
-        self._path = '/dev/null'
-        self._message_factory = mailbox.mboxMessage
 
+def message_text(message):
+    # what the term index covers: the raw headers and the decoded body
+    text = message.raw().partition('\n\n')[0]
+    body = message_body(message.message())
+    if body is NO_BODY_PART:
+        return text
+    return text + '\n' + body
 
-def webdatetime(txt):
-    if txt is None or txt == '':
-        return datetime.now()
 
+def load_term_index(fs_converted_url, validator):
     try:
-        txt_split = txt.split(" ")
-        txt_split = txt_split[:-1]
-        checktxt = ' '.join(txt_split)
-        return datetime.datetime.strptime(checktxt, '%a, %d %b %Y %H:%M:%S')
-    except ValueError, v:
-        print "Error converting %s" % txt
-        raise v
+        with open(term_index_filename(fs_converted_url), 'rb') as fileop:
+            stored = marshal.load(fileop)
+        if stored['version'] != TERM_INDEX_VERSION or \
+           stored['validator'] != validator:
+            return None
+        return stored
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        return None
 
 
-def cached_url_filename(url):
-    fs_converted_url = re.sub('[/:@]+', '_', url)
+def build_term_index(fs_converted_url, mbx, validator):
+    postings = {}
+    for position, message in enumerate(mbx.itermessages()):
+        for term in message_terms(message_text(message)):
+            if term not in postings:
+                postings[term] = array.array('I')
+            postings[term].append(position)
+
+    stored = {'version': TERM_INDEX_VERSION,
+              'validator': validator,
+              'terms': dict((term, positions.tostring())
+                            for term, positions in postings.iteritems())}
+    store_term_index(fs_converted_url, stored)
+    return stored
+
+
+def extend_term_index(fs_converted_url, mbx, stored, first):
+    # postings only ever gain positions, so the messages from first on are
+    # simply added; a term the grown last message lost stays harmlessly
+    postings = {}
+    for message in mbx.iterindexed(xrange(first,
+                                          len(mbx.index()['offsets']))):
+        for term in message_terms(message_text(message)):
+            if term not in postings:
+                postings[term] = array.array('I')
+            postings[term].append(message.position())
+    for term, positions in postings.iteritems():
+        stored['terms'][term] = stored['terms'].get(term, '') + \
+            positions.tostring()
+    stored['validator'] = mbx.index()['validator']
+    store_term_index(fs_converted_url, stored)
+
+
+def store_term_index(fs_converted_url, stored):
+    tmpname = cache_tmpname(term_index_filename(fs_converted_url))
+    try:
+        with open(tmpname, 'wb') as fileop:
+            marshal.dump(stored, fileop)
+        os.rename(tmpname, term_index_filename(fs_converted_url))
+    except (IOError, OSError):
+        pass
+
+
+def term_candidates(terms, literal):
+    # messages which may contain literal, or None if the index cannot tell
+    candidates = None
+    for token in TERM_RE.findall(literal.lower()):
+        if len(token) >= TERM_GRAM:
+            # a message holding token holds all of its windows; the rarest
+            # go first so the set shrinks early
+            postings = [terms['terms'].get(gram, '')
+                        for gram in term_grams(token)]
+            postings.sort(key=len)
+            found = set(array.array('I', postings[0]))
+            for positions in postings[1:]:
+                if not found:
+                    break
+                found.intersection_update(array.array('I', positions))
+        else:
+            # shorter tokens are part of a window or a short word
+            found = set()
+            for term, positions in terms['terms'].iteritems():
+                if token in term:
+                    found.update(array.array('I', positions))
+        if candidates is None:
+            candidates = found
+        else:
+            candidates &= found
+    return candidates
+
+
+def regex_literals(pattern):
+    # literal runs every match of pattern has to contain
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError, RuntimeError):
+        return None
+
+    literals = []
+    current = ''
+    for op, av in parsed:
+        if op == sre_constants.LITERAL and av < 256:
+            current += chr(av)
+            continue
+        if op == sre_constants.BRANCH:
+            return None
+        if current:
+            literals.append(current)
+        current = ''
+    if current:
+        literals.append(current)
+    return literals
+
+
+def url_map_filename(fs_converted_url):
+    return fs_converted_url + '.urls'
+
+
+def squash_spaces(text):
+    return ' '.join((text or '').split())
+
+
+def parse_thread_page(html):
+    parser = HTMLParser.HTMLParser()
+
+    def unescape(text):
+        return parser.unescape(text.decode('utf-8', 'replace')). \
+            encode('utf-8')
+
+    for kind, regex in (('mhonarc', MHONARC_LINK_RE),
+                        ('pipermail', PIPERMAIL_LINK_RE)):
+        links = []
+        for match in regex.finditer(html):
+            url = match.group('url')
+            links.append((int(re.sub('[^0-9]', '', url) or 0), url,
+                          squash_spaces(unescape(match.group('subject'))),
+                          squash_spaces(unescape(match.group('sender') or
+                                                 ''))))
+        if links:
+            return kind, links
+    return None, []
+
+
+def load_url_map(fs_converted_url, validator):
+    try:
+        with open(url_map_filename(fs_converted_url), 'rb') as fileop:
+            stored = marshal.load(fileop)
+        if stored['version'] != URL_MAP_VERSION or \
+           stored['validator'] != validator:
+            return None
+        return stored
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        return None
+
+
+def build_url_map(fs_converted_url, mbx, page_path, validator):
+    with open(page_path, 'r') as fileop:
+        kind, links = parse_thread_page(fileop.read())
+
+    subjects = {}
+    for number, url, subject, sender in links:
+        subjects.setdefault(subject, []).append((url, sender))
+
+    # the index pages number messages in archive order, so when every
+    # message has a link the two line up and each Message-ID gets its page
+    message_ids_to_urls = {}
+    headers = mbx.index()['headers']['message-id']
+    if len(links) == len(headers):
+        for link, header in zip(sorted(links), headers):
+            for msgid in message_ids(header)[:1]:
+                message_ids_to_urls[msgid] = link[1]
+
+    stored = {'version': URL_MAP_VERSION,
+              'validator': validator,
+              'kind': kind,
+              'subjects': subjects,
+              'message-ids': message_ids_to_urls}
+
+    tmpname = cache_tmpname(url_map_filename(fs_converted_url))
+    try:
+        with open(tmpname, 'wb') as fileop:
+            marshal.dump(stored, fileop)
+        os.rename(tmpname, url_map_filename(fs_converted_url))
+    except (IOError, OSError):
+        pass
+    return stored
+
 
+def message_urls(url_map, message):
+    for msgid in message_ids(message['message-id'])[:1]:
+        if msgid in url_map['message-ids']:
+            return [url_map['message-ids'][msgid]]
+
+    subject = squash_spaces(message['subject'])
+    entries = url_map['subjects'].get(subject)
+    if entries is None:
+        # index pages may cut a long subject short
+        entries = []
+        for listed, found in url_map['subjects'].iteritems():
+            if listed and subject.startswith(listed):
+                entries.extend(found)
+        entries.sort()
+    sender = squash_spaces(email.utils.parseaddr(message['from'] or '')[0])
+    by_sender = [url for url, who in entries if sender and who == sender]
+    return by_sender or [url for url, who in entries]
+
+
+def archive_index_filename(fs_converted_url):
+    return fs_converted_url + '.idx'
+
+
+def archive_validator(fs_converted_url):
+    st = os.stat(fs_converted_url)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def load_archive_index(fs_converted_url):
+    try:
+        with open(archive_index_filename(fs_converted_url), 'rb') as fileop:
+            stored = marshal.load(fileop)
+        if stored['version'] != INDEX_VERSION or \
+           stored['validator'] != archive_validator(fs_converted_url):
+            return None
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+        return None
+
+    index = {'validator': stored['validator'],
+             'headers': stored['headers']}
+    for column, typecode in INDEX_ARRAYS:
+        index[column] = array.array(typecode)
+        index[column].fromstring(stored[column])
+    return index
+
+
+def index_message(index, message):
+    headers = message.headers()
+    timestamp = float('nan')
+    try:
+        timestamp = email.utils.mktime_tz(
+            email.utils.parsedate_tz(headers['date']))
+    except (TypeError, ValueError, OverflowError):
+        pass
+    index['offsets'].append(message.offset())
+    index['lengths'].append(message.length())
+    index['timestamps'].append(timestamp)
+    for field in INDEXED_FIELDS:
+        index['headers'][field].append(headers[field])
+
+
+def build_archive_index(fs_converted_url, mbx):
+    index = {'validator': archive_validator(fs_converted_url),
+             'headers': dict((field, []) for field in INDEXED_FIELDS)}
+    for column, typecode in INDEX_ARRAYS:
+        index[column] = array.array(typecode)
+
+    for message in mbx.itermessages():
+        index_message(index, message)
+    store_archive_index(fs_converted_url, index)
+    return index
+
+
+def extend_archive_index(fs_converted_url, mbx, index):
+    # mbx holds what index was built from plus appended messages; the last
+    # indexed message is looked at again, as it may have grown as well
+    first = max(len(index['offsets']) - 1, 0)
+    start = 0
+    if index['offsets']:
+        start = index['offsets'][first]
+    for column, typecode in INDEX_ARRAYS:
+        del index[column][first:]
+    for field in INDEXED_FIELDS:
+        del index['headers'][field][first:]
+
+    for message in mbx.itermessages(start=start):
+        index_message(index, message)
+    index['validator'] = archive_validator(fs_converted_url)
+    store_archive_index(fs_converted_url, index)
+    return first
+
+
+def store_archive_index(fs_converted_url, index):
+    stored = {'version': INDEX_VERSION,
+              'validator': index['validator'],
+              'headers': index['headers']}
+    for column, typecode in INDEX_ARRAYS:
+        stored[column] = index[column].tostring()
+
+    tmpname = cache_tmpname(archive_index_filename(fs_converted_url))
+    try:
+        with open(tmpname, 'wb') as fileop:
+            marshal.dump(stored, fileop)
+        os.rename(tmpname, archive_index_filename(fs_converted_url))
+    except (IOError, OSError):
+        pass
+
+
+def cache_directory():
     if os.getenv("SMA_CACHE_LOCATION"):
         path_to_fs = os.getenv("SMA_CACHE_LOCATION")
     else:
@@ -85,31 +778,261 @@ def cached_url_filename(url):
 
     if not os.path.exists(path_to_fs):
         os.makedirs(path_to_fs)
-    return path_to_fs + '/' + fs_converted_url
+    return path_to_fs
+
+
+def cached_url_filename(url):
+    fs_converted_url = re.sub('[/:@]+', '_', url)
+    return cache_directory() + '/' + fs_converted_url
+
+
+def cache_meta_filename(fs_converted_url):
+    return fs_converted_url + '.meta'
+
+
+def read_cache_meta(fs_converted_url):
+    try:
+        with open(cache_meta_filename(fs_converted_url), 'r') as fileop:
+            return json.load(fileop)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_cache_meta(fs_converted_url, meta):
+    with open(cache_meta_filename(fs_converted_url), 'w') as fileop:
+        json.dump(meta, fileop)
+
+
+class http_response(object):
+    def __init__(self, url, code, headers, body):
+        self._url = url
+        self._code = code
+        self._headers = headers
+        self._body = body
 
+    def geturl(self):
+        return self._url
 
-def url_open_resp(url):
-    global opener, login_user, login_pass
-    if not opener and login_user:
-        if login_user:
-            opener = urllib2.build_opener(urllib2.HTTPCookieProcessor())
+    def getcode(self):
+        return self._code
+
+    def info(self):
+        return self._headers
+
+    def read(self):
+        return self._body
+
+
+class connection_pool(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def get(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+
+        if scheme == 'https':
+            ctx = None
+            if accept_all_certs:
+                ctx = ssl.create_default_context()
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            conn = httplib.HTTPSConnection(netloc, timeout=HTTP_TIMEOUT,
+                                           context=ctx)
         else:
-            opener = urllib2.build_opener()
-        urllib2.install_opener(opener)
+            conn = httplib.HTTPConnection(netloc, timeout=HTTP_TIMEOUT)
+        return conn, False
+
+    def put(self, scheme, netloc, conn):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
 
-    params = None
-    if login_user:
-        params = urllib.urlencode(dict(username=login_user,
-                                       password=login_pass))
 
-    if not accept_all_certs:
-        response = urllib2.urlopen(url, data=params)
+http_connections = connection_pool()
+
+
+def pooled_url_open_resp(url, headers, data, redirects=5):
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    headers = dict(headers)
+    if cookie_jar is not None:
+        request = urllib2.Request(url)
+        cookie_jar.add_cookie_header(request)
+        headers.update(request.unredirected_hdrs)
+
+    method = 'GET'
+    if data is not None:
+        method = 'POST'
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    while True:
+        conn, reused = http_connections.get(parts.scheme, parts.netloc)
+        try:
+            conn.request(method, path, data, headers)
+            resp = conn.getresponse()
+            body = resp.read()
+            break
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            # an idle connection may have been dropped by the server
+            if not reused:
+                raise
+
+    if resp.will_close:
+        conn.close()
     else:
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-        response = urllib2.urlopen(url, context=ctx)
+        http_connections.put(parts.scheme, parts.netloc, conn)
+
+    response = http_response(url, resp.status, resp.msg, body)
+    if cookie_jar is not None:
+        cookie_jar.extract_cookies(response, urllib2.Request(url))
+
+    location = resp.getheader('location')
+    if resp.status in (301, 302, 303, 307) and location and redirects:
+        if resp.status != 307 and data is not None:
+            # like urllib2, the form is only posted again on a 307; other
+            # redirects are followed with a plain GET
+            data = None
+            headers = dict((name, value) for name, value
+                           in headers.iteritems()
+                           if name.lower() not in ('content-type',
+                                                   'content-length'))
+        return pooled_url_open_resp(urlparse.urljoin(url, location),
+                                    headers, data, redirects - 1)
+
+    if resp.status >= 400:
+        raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg,
+                                StringIO.StringIO(body))
+
+    return response
+
+
+def host_slot(url):
+    # bounds the requests in flight to one server, whatever -j allows
+    netloc = urlparse.urlsplit(url).netloc
+    with host_slots_lock:
+        if netloc not in host_slots:
+            host_slots[netloc] = threading.BoundedSemaphore(host_jobs)
+        return host_slots[netloc]
+
+
+def send_request(url, headers, data=None):
+    if host_jobs is None:
+        return send_host_request(url, headers, data)
+    with host_slot(url):
+        return send_host_request(url, headers, data)
+
+
+def send_host_request(url, headers, data=None):
+    # proxied requests go through urllib2, everything else shares
+    # keep-alive connections per host
+    scheme = urlparse.urlsplit(url).scheme
+    if not urllib.getproxies().get(scheme):
+        return pooled_url_open_resp(url, headers, data)
+
+    request = urllib2.Request(url, headers=headers)
+    try:
+        if not accept_all_certs:
+            response = urllib2.urlopen(request, data=data)
+        else:
+            ctx = ssl.create_default_context()
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+            response = urllib2.urlopen(request, data=data, context=ctx)
+    except urllib2.HTTPError, e:
+        if e.code != 304:
+            raise
+        response = e
+
+    return http_response(response.geturl(), response.getcode(),
+                         response.info(), response.read())
 
+
+def cookie_filename():
+    return cache_directory() + '/' + CACHE_COOKIES
+
+
+def session_cookies():
+    # the session cookies of every host, kept next to the cache between runs
+    global opener, cookie_jar
+    with opener_lock:
+        if cookie_jar is None:
+            cookie_jar = cookielib.LWPCookieJar(cookie_filename())
+            try:
+                cookie_jar.load(ignore_discard=True)
+            except (IOError, cookielib.LoadError):
+                pass
+            opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(cookie_jar))
+            urllib2.install_opener(opener)
+    return cookie_jar
+
+
+def save_cookies():
+    if cookie_jar is None:
+        return
+    filename = cookie_filename()
+    tmpname = cache_tmpname(filename)
+    try:
+        # the file holds live sessions, so only the user may read it
+        os.close(os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0600))
+        cookie_jar.save(tmpname, ignore_discard=True)
+        os.rename(tmpname, filename)
+    except (IOError, OSError):
+        pass
+
+
+def login_page(response):
+    content_type = response.info().getheader('content-type') or ''
+    return 'html' in content_type.lower() and \
+        LOGIN_FORM_RE.search(response.read()) is not None
+
+
+def login_session(url, stale=None):
+    # log in once per host, unless a session saved by an earlier run is
+    # still good; every other request is a plain GET carrying its cookie.
+    # Returns the session in use, which is replaced when it is the stale
+    # one a request just found rejected
+    parts = urlparse.urlsplit(url)
+    host = (parts.scheme, parts.netloc)
+    jar = session_cookies()
+    with session_lock:
+        session = session_hosts.get(host)
+        if session is not None and session != stale:
+            return session
+        if session is None:
+            request = urllib2.Request(url)
+            jar.add_cookie_header(request)
+            if request.has_header('Cookie'):
+                session_hosts[host] = 0
+                return 0
+        params = urllib.urlencode(dict(username=login_user,
+                                       password=login_pass))
+        if login_page(send_request(url, {}, params)) and not session:
+            print >>diagnostics, "Unable to log in to [%s]" % parts.netloc
+        session_hosts[host] = (session or 0) + 1
+        save_cookies()
+        return session_hosts[host]
+
+
+def url_open_resp(url, headers={}):
+    if not login_user:
+        return send_request(url, headers)
+
+    session = login_session(url)
+    response = send_request(url, headers)
+    if login_page(response):
+        # the server dropped the session: log in again, once for all the
+        # requests that found out at the same time
+        login_session(url, session)
+        response = send_request(url, headers)
     return response
 
 
@@ -118,41 +1041,417 @@ def url_open(url):
     return response.read()
 
 
-def cached_url_open(url, is_zipped=False):
+def cache_tmpname(fs_converted_url):
+    return '%s.tmp.%d.%d' % (fs_converted_url, os.getpid(),
+                             threading.current_thread().ident)
+
+
+def remove_cache_entry(fs_converted_url):
+    for path in (fs_converted_url, cache_meta_filename(fs_converted_url),
+                 archive_index_filename(fs_converted_url),
+                 term_index_filename(fs_converted_url),
+                 url_map_filename(fs_converted_url)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def cache_budget():
+    match = re.match(r'^\s*([0-9]+)\s*([kmg]?)b?\s*$',
+                     os.getenv('SMA_CACHE_SIZE', '').lower())
+    if match is None:
+        return None
+    return int(match.group(1)) * CACHE_SIZE_UNITS[match.group(2)]
+
+
+def cache_list_url(url):
+    # the list a cached page belongs to: its archive directory
+    return re.sub(r'[^/]*(/thread\.html)?$', '', url)
+
+
+class cache_journal(object):
+    # when each cache entry was last used, and how often each list was
+    # served from the cache; kept in memory and merged into the journal
+    # file of the cache directory on the way out
+    def __init__(self):
+        self._entries = {}
+        self._counts = {}
+        self._touched = set()
+        self._lock = threading.Lock()
+
+    def record(self, url, fs_converted_url, hit=None):
+        list_url = cache_list_url(url)
+        entry = os.path.basename(fs_converted_url)
+        with self._lock:
+            self._entries[entry] = {'accessed': time.time(),
+                                    'list': list_url}
+            self._touched.add(entry)
+            if hit is not None:
+                counts = self._counts.setdefault(list_url, [0, 0])
+                counts[0 if hit else 1] += 1
+
+    def touched(self):
+        # entries used by this process, which trimming leaves alone
+        with self._lock:
+            return set(self._touched)
+
+    def load(self):
+        try:
+            with open(cache_directory() + '/' + CACHE_JOURNAL, 'r') as fileop:
+                stored = json.load(fileop)
+        except (IOError, OSError, ValueError):
+            stored = {}
+        if not isinstance(stored, dict):
+            stored = {}
+        stored.setdefault('entries', {})
+        stored.setdefault('lists', {})
+        with self._lock:
+            stored['entries'].update(self._entries)
+            for list_url, counts in self._counts.iteritems():
+                totals = stored['lists'].setdefault(list_url, [0, 0])
+                totals[0] += counts[0]
+                totals[1] += counts[1]
+        return stored
+
+    def save(self, stored=None):
+        with self._lock:
+            if not self._entries and stored is None:
+                return
+        if stored is None:
+            stored = self.load()
+        journal = cache_directory() + '/' + CACHE_JOURNAL
+        tmpname = cache_tmpname(journal)
+        try:
+            with open(tmpname, 'w') as fileop:
+                json.dump(stored, fileop)
+            os.rename(tmpname, journal)
+        except (IOError, OSError):
+            return
+        with self._lock:
+            self._entries.clear()
+            self._counts.clear()
+
+
+cache_access = cache_journal()
+cache_trim_lock = threading.Lock()
+# bytes in the cache: measured once, then counted up as entries are written
+cache_usage = None
+cache_usage_lock = threading.Lock()
+
+
+def cache_entries():
+    # the size of every cache entry, counting in its sidecar files
+    entries = {}
+    path_to_fs = cache_directory()
+    for name in os.listdir(path_to_fs):
+        if name in (CACHE_JOURNAL, CACHE_CHECKPOINTS, CACHE_COOKIES) or \
+           '.tmp.' in name:
+            continue
+        entry = name
+        for suffix in CACHE_SIDECARS:
+            if name.endswith(suffix):
+                entry = name[:-len(suffix)]
+                break
+        try:
+            size = os.path.getsize(path_to_fs + '/' + name)
+        except OSError:
+            continue
+        entries[entry] = entries.get(entry, 0) + size
+    return entries
+
+
+def cache_entry_is_active(entry, now):
+    # the month still being written to is never evicted, it would only be
+    # fetched again on the next search
+    match = re.search(r'(\d{4}(-[A-Za-z]+|q[1-4])?|(Week-of-Mon-)?\d{8})'
+                      r'\.txt\.gz$', entry)
+    if match is None:
+        return False
+    period = archive_period(match.group(0))
+    return period is not None and period[1] + ARCHIVE_DATE_SLACK > now
+
+
+def trim_cache(budget, spare_touched=True):
+    with cache_trim_lock:
+        entries = cache_entries()
+        total = sum(entries.itervalues())
+        if total <= budget:
+            return total
+        stored = cache_access.load()
+        touched = set()
+        if spare_touched:
+            touched = cache_access.touched()
+        now = time.time()
+        candidates = []
+        for entry, size in entries.iteritems():
+            if entry in touched or cache_entry_is_active(entry, now):
+                continue
+            accessed = stored['entries'].get(entry, {}).get('accessed', 0)
+            # closed volumes go first: they never change, so fetching one
+            # again costs a single download
+            closed = re.search(r'\.txt\.gz$', entry) is not None
+            candidates.append((not closed, accessed, entry, size))
+        candidates.sort()
+
+        path_to_fs = cache_directory()
+        for is_page, accessed, entry, size in candidates:
+            if total <= budget:
+                break
+            remove_cache_entry(path_to_fs + '/' + entry)
+            stored['entries'].pop(entry, None)
+            total -= size
+        cache_access.save(stored)
+        return total
+
+
+def cache_grew(nbytes):
+    # the directory is only looked at again once the count goes over budget
+    global cache_usage
+    budget = cache_budget()
+    if budget is None:
+        return
+    with cache_usage_lock:
+        if cache_usage is None:
+            cache_usage = sum(cache_entries().itervalues())
+        else:
+            cache_usage += nbytes
+        if cache_usage <= budget:
+            return
+    remaining = trim_cache(budget)
+    with cache_usage_lock:
+        # whatever is left over budget is in use by this run and stays until
+        # close_cache, as does anything written from now on
+        cache_usage = remaining if remaining <= budget else float('-inf')
+
+
+def close_cache():
+    # while searching, entries in use are spared; on the way out the cache is
+    # brought back within its budget
+    cache_access.save()
+    save_cookies()
+    budget = cache_budget()
+    if budget is not None:
+        trim_cache(budget, False)
+
+
+def cache_stats():
+    entries = cache_entries()
+    stored = cache_access.load()
+    lists = {}
+    for entry, size in entries.iteritems():
+        list_url = stored['entries'].get(entry, {}).get('list', '(unknown)')
+        found = lists.setdefault(list_url, [0, 0])
+        found[0] += size
+        found[1] += 1
+
+    budget = cache_budget()
+    print "Cache at %s: %d bytes in %d entries%s" % \
+        (cache_directory(), sum(entries.itervalues()), len(entries),
+         '' if budget is None else ' (budget %d bytes)' % budget)
+    for list_url in sorted(set(lists) | set(stored['lists'])):
+        size, count = lists.get(list_url, [0, 0])
+        hits, misses = stored['lists'].get(list_url, [0, 0])
+        rate = ''
+        if hits + misses:
+            rate = ' (%.1f%% hits)' % (100.0 * hits / (hits + misses))
+        print "%s: %d bytes in %d entries, %d hits, %d misses%s" % \
+            (list_url, size, count, hits, misses, rate)
+
+
+def cache_compression():
+    mode = os.getenv('SMA_CACHE_COMPRESSION', 'gzip').lower()
+    if mode == 'zstd' and zstandard is None:
+        mode = 'gzip'
+    if mode not in ('gzip', 'zstd', 'none'):
+        mode = 'gzip'
+    return mode
+
+
+def unwrap_gzip(data):
+    # some servers hand the archive out gzipped twice
+    while data[:2] == GZIP_MAGIC:
+        if gzip.GzipFile(fileobj=StringIO.StringIO(data)).read(2) != \
+           GZIP_MAGIC:
+            break
+        data = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+    return data
+
+
+def cached_archive_reader(fileop):
+    # the readers do not close the file under them, that is up to the caller
+    magic = fileop.read(4)
+    fileop.seek(0)
+    if magic[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fileop, mode='rb')
+    if magic == ZSTD_MAGIC:
+        # synced entries are a series of frames, one per appended tail
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileop, read_across_frames=True)
+    return fileop
+
+
+def cached_archive_compression(fs_converted_url):
+    with open(fs_converted_url, 'rb') as fileop:
+        magic = fileop.read(4)
+    if magic[:2] == GZIP_MAGIC:
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return 'none'
+
+
+def mmap_file(fileop):
+    if os.fstat(fileop.fileno()).st_size == 0:
+        return ''
+    return mmap.mmap(fileop.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def mmap_cached_archive(fs_converted_url):
+    with open(fs_converted_url, 'rb') as source:
+        stream = cached_archive_reader(source)
+        if stream is source:
+            return mmap_file(source)
+        # compressed entries are inflated once into an unlinked temporary
+        # file, so the mapping is backed by the page cache, not the heap
+        with tempfile.TemporaryFile() as fileop:
+            shutil.copyfileobj(stream, fileop, COPY_CHUNK_SIZE)
+            fileop.flush()
+            return mmap_file(fileop)
+
+
+def write_cached_archive(fs_converted_url, data):
+    mode = cache_compression()
+    data = unwrap_gzip(data)
+    tmpname = cache_tmpname(fs_converted_url)
+    with open(tmpname, 'wb') as fileop:
+        if mode == 'gzip' and data[:2] == GZIP_MAGIC:
+            fileop.write(data)
+        else:
+            if data[:2] == GZIP_MAGIC:
+                stream = gzip.GzipFile(fileobj=StringIO.StringIO(data))
+            elif data[:4] == ZSTD_MAGIC:
+                stream = zstandard.ZstdDecompressor().stream_reader(
+                    StringIO.StringIO(data))
+            else:
+                stream = StringIO.StringIO(data)
+            if mode == 'gzip':
+                writer = gzip.GzipFile(filename='', fileobj=fileop,
+                                       mode='wb')
+            elif mode == 'zstd':
+                writer = zstandard.ZstdCompressor(
+                    level=ZSTD_LEVEL).stream_writer(fileop)
+            else:
+                writer = fileop
+            shutil.copyfileobj(stream, writer, COPY_CHUNK_SIZE)
+            if writer is not fileop:
+                writer.close()
+    os.rename(tmpname, fs_converted_url)
+
+
+def append_cached_archive(fs_converted_url, data):
+    # the tail goes in as a gzip member or zstd frame of its own, both of
+    # which readers take as a continuation of the stream
+    with open(fs_converted_url, 'rb') as fileop:
+        magic = fileop.read(4)
+    tmpname = cache_tmpname(fs_converted_url)
+    shutil.copyfile(fs_converted_url, tmpname)
+    with open(tmpname, 'ab') as fileop:
+        if magic[:2] == GZIP_MAGIC:
+            writer = gzip.GzipFile(filename='', fileobj=fileop, mode='wb')
+            writer.write(data)
+            writer.close()
+        elif magic == ZSTD_MAGIC:
+            fileop.write(zstandard.ZstdCompressor(level=ZSTD_LEVEL).
+                         compress(data))
+        else:
+            fileop.write(data)
+    os.rename(tmpname, fs_converted_url)
+
+
+def migrate_cached_archive(fs_converted_url):
+    # caches written before compression support hold the plain mbox text
+    with open(fs_converted_url, 'rb') as fileop:
+        magic = fileop.read(4)
+    if magic[:2] == GZIP_MAGIC or magic == ZSTD_MAGIC or \
+       cache_compression() == 'none':
+        return
+    mtime = os.path.getmtime(fs_converted_url)
+    with open(fs_converted_url, 'rb') as fileop:
+        write_cached_archive(fs_converted_url, fileop.read())
+    os.utime(fs_converted_url, (mtime, mtime))
+
+
+def cached_url_fetch(url, is_zipped=False, cached_only=False):
     fs_converted_url = cached_url_filename(url)
+    if cached_only and os.path.exists(fs_converted_url):
+        run_stats.count('cache hits')
+        cache_access.record(url, fs_converted_url, True)
+        return fs_converted_url
     if os.path.exists(fs_converted_url):
-        request = urllib2.Request(url)
-        request.get_method = lambda: 'HEAD'
+        meta = read_cache_meta(fs_converted_url)
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last-modified'):
+            headers['If-Modified-Since'] = meta['last-modified']
+        else:
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                os.path.getmtime(fs_converted_url), usegmt=True)
+        started = time.time()
         try:
-            response = url_open_resp(request)
-            headers = response.info()
-            webdate = webdatetime(headers['last-modified'])
+            response = url_open_resp(url, headers)
         except:
-            webdate = datetime.datetime.fromtimestamp(0.0)
-        filedate = datetime.datetime.fromtimestamp(
-                                    os.path.getmtime(fs_converted_url))
-        if filedate >= webdate:
-            fileop = open(fs_converted_url, 'r')
-            return fileop.read()
+            response = None
+        if response is None or response.getcode() == 304:
+            run_stats.add('fetch', time.time() - started, 0, 1,
+                          stats_archive_name(url))
+            run_stats.count('cache hits')
+            if is_zipped:
+                migrate_cached_archive(fs_converted_url)
+            cache_access.record(url, fs_converted_url, True)
+            return fs_converted_url
+    else:
+        started = time.time()
+        response = url_open_resp(url)
+
+    data = response.read()
+    run_stats.add('fetch', time.time() - started, len(data), 1,
+                  stats_archive_name(url))
+    run_stats.count('cache misses')
+    previous = 0
+    if os.path.exists(fs_converted_url):
+        previous = os.path.getsize(fs_converted_url)
+    if is_zipped:
+        write_cached_archive(fs_converted_url, data)
+    else:
+        with open(fs_converted_url, 'w') as fileop:
+            fileop.write(data)
 
-    result = url_open(url)
+    write_cache_meta(fs_converted_url,
+                     {'etag': response.info().getheader('etag'),
+                      'last-modified':
+                      response.info().getheader('last-modified')})
 
-    if is_zipped:
-        zipdata = gzip.GzipFile(fileobj=StringIO.StringIO(result))
-        result = zipdata.read()
+    cache_access.record(url, fs_converted_url, False)
+    cache_grew(os.path.getsize(fs_converted_url) - previous)
+    return fs_converted_url
 
-    fileop = open(fs_converted_url, 'w')
-    fileop.write(result)
 
-    return result
+def cached_url_open(url, is_zipped=False):
+    fs_converted_url = cached_url_fetch(url, is_zipped)
+    with open(fs_converted_url, 'rb') as fileop:
+        if is_zipped:
+            return cached_archive_reader(fileop).read()
+        return fileop.read()
 
 
 def mailman_archives(MailmanUrl):
+    started = time.time()
     try:
         html = cached_url_open(MailmanUrl)
     except:
-        print "Unable to open [%s]" % MailmanUrl
+        print >>diagnostics, "Unable to open [%s]" % MailmanUrl
         return []
+    run_stats.add('list', time.time() - started, len(html), 1)
 
     grp = re.findall('href="[^"]+.txt.gz"', html)
 
@@ -166,19 +1465,246 @@ def mailman_archives(MailmanUrl):
     return archives
 
 
-def get_mailman_mailbox_from_archive(ArchiveUrl):
+def archive_period(arch):
+    # the [start, end) UTC interval covered by a pipermail archive volume
+    name = os.path.basename(arch).replace('.txt.gz', '')
+    match = re.match(r'^(\d{4})-([A-Za-z]+)$', name)
+    if match and match.group(2).lower() in MONTH_NAMES:
+        year = int(match.group(1))
+        month = MONTH_NAMES.index(match.group(2).lower()) + 1
+        start = (year, month, 1)
+        end = (year + month // 12, month % 12 + 1, 1)
+    elif re.match(r'^\d{4}q[1-4]$', name):
+        year, quarter = int(name[:4]), int(name[5])
+        start = (year, quarter * 3 - 2, 1)
+        end = (year + quarter // 4, quarter % 4 * 3 + 1, 1)
+    elif re.match(r'^\d{4}$', name):
+        start = (int(name), 1, 1)
+        end = (int(name) + 1, 1, 1)
+    else:
+        match = re.match(r'^(Week-of-Mon-)?(\d{4})(\d\d)(\d\d)$', name)
+        if not match:
+            return None
+        day = datetime.date(int(match.group(2)), int(match.group(3)),
+                            int(match.group(4)))
+        if match.group(1):
+            span = datetime.timedelta(days=7)
+        else:
+            span = datetime.timedelta(days=1)
+        start = day.timetuple()[:3]
+        end = (day + span).timetuple()[:3]
+    return (calendar.timegm(start + (0, 0, 0)),
+            calendar.timegm(end + (0, 0, 0)))
+
+
+def archive_may_match(arch, bounds):
+    period = archive_period(arch)
+    if period is None:
+        return True
+    lower, upper = bounds
+    # mailman files by local time and clobbers skewed Date headers only
+    # past ARCHIVER_ALLOWABLE_SANE_DATE_SKEW, so widen the volume by that
+    if lower is not None and period[1] + ARCHIVE_DATE_SLACK <= lower:
+        return False
+    if upper is not None and period[0] - ARCHIVE_DATE_SLACK >= upper:
+        return False
+    return True
+
+
+def sync_archive(ArchiveUrl):
+    # pipermail keeps the plain .txt of the running month up to date and
+    # only ever appends to it, so the cache just needs the bytes past what
+    # it already holds
+    fs_converted_url = cached_url_filename(ArchiveUrl)
+    if not os.path.exists(fs_converted_url):
+        print "Fetching [%s]" % ArchiveUrl
+        return get_mailman_mailbox_from_archive(ArchiveUrl) is not None
+
+    TextUrl = re.sub(r'\.gz$', '', ArchiveUrl)
+    mbx = mmappedMbox(fs_converted_url, ArchiveUrl)
+    index = mbx.index()
+    terms = load_term_index(fs_converted_url, index['validator'])
+    size = len(mbx.buffer())
+    overlap = min(size, SYNC_OVERLAP)
+    try:
+        response = url_open_resp(TextUrl,
+                                 {'Range': 'bytes=%d-' % (size - overlap)})
+        data = response.read()
+    except urllib2.HTTPError, e:
+        if e.code != 416:
+            print "Unable to sync [%s]: %s" % (TextUrl, e)
+            return False
+        # the text is shorter than the cached copy, which means it was
+        # rewritten
+        response, data = None, None
+    except Exception, e:
+        print "Unable to sync [%s]: %s" % (TextUrl, e)
+        return False
+
+    tail = None
+    if response is not None and response.getcode() == 206:
+        if data[:overlap] == mbx.raw(size - overlap, size):
+            tail = data[overlap:]
+    elif response is not None and response.getcode() == 200:
+        # the server ignored the range, so this is the whole text again
+        if data[:size] == mbx.raw(0, size):
+            tail = data[size:]
+
+    if tail is None:
+        # the bytes in front of the tail differ: start over from the full
+        # text, the derived files are rebuilt for it on first use
+        print "Archive [%s] changed, fetching it again" % TextUrl
+        if response is None or response.getcode() != 200:
+            data = url_open(TextUrl)
+        write_cached_archive(fs_converted_url, data)
+        # the validators were for the .gz as it was; without them the next
+        # fetch asks whether the .gz changed since this copy was written
+        write_cache_meta(fs_converted_url, {})
+        mmappedMbox(fs_converted_url, ArchiveUrl).index()
+        return True
+
+    if not tail:
+        print "Archive [%s] is up to date" % TextUrl
+        return True
+
+    append_cached_archive(fs_converted_url, tail)
+    write_cache_meta(fs_converted_url, {})
+    cache_access.record(ArchiveUrl, fs_converted_url)
+    mbx = mmappedMbox(fs_converted_url, ArchiveUrl)
+    first = extend_archive_index(fs_converted_url, mbx, index)
+    if terms is not None:
+        extend_term_index(fs_converted_url, mbx, terms, first)
+    print "Appended %d bytes to [%s]" % (len(tail), fs_converted_url)
+    return True
+
+
+def get_mailman_mailbox_from_archive(ArchiveUrl, cached_only=False):
     # print "Scanning %s" % ArchiveUrl
     try:
-        unzipped = cached_url_open(ArchiveUrl, True)
+        fs_converted_url = cached_url_fetch(ArchiveUrl, True, cached_only)
     except:
-        print "Unable to open mailbox [%s]" % ArchiveUrl
+        print >>diagnostics, "Unable to open mailbox [%s]" % ArchiveUrl
         return None
-    # Check for gzipped file
-    if unzipped[0] == '\x1f' and unzipped[1] == '\x8b':
-        zipped = unzipped
-        unzipped = gzip.GzipFile(fileobj=StringIO.StringIO(zipped))
 
-    return streammedMbox(unzipped)
+    mbx = mmappedMbox(fs_converted_url, ArchiveUrl)
+    # (re)build the header index while the archive is fresh
+    mbx.index()
+    return mbx
+
+
+def decoded_part(part):
+    payload = part.get_payload(decode=True)
+    if payload is None:
+        return ''
+    charset = part.get_content_charset()
+    if charset:
+        try:
+            payload = payload.decode(charset, 'replace').encode('utf-8')
+        except (LookupError, UnicodeError):
+            pass
+    return payload
+
+
+def message_body(message):
+    # the text the body filters look at: every text part of the MIME tree,
+    # transfer- and charset-decoded; a single-part message always counts
+    if not message.is_multipart():
+        return decoded_part(message)
+    texts = []
+    leaves = 0
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        leaves += 1
+        if part.get_content_maintype() == 'text':
+            texts.append(decoded_part(part))
+    if not leaves:
+        return NO_BODY_PART
+    return '\n'.join(texts)
+
+
+def message_ids(header):
+    if header is None:
+        return []
+    return MESSAGE_ID_RE.findall(header)
+
+
+def thread_key(fields):
+    ids = message_ids(fields.get('Message-ID'))
+    if ids:
+        return ids[0]
+    # without a Message-ID a message can only stand for itself
+    return '<no-id:%r>' % ((fields.get('From'), fields.get('Date'),
+                            fields.get('Subject')),)
+
+
+class thread_index(object):
+    def __init__(self):
+        self._parent = {}
+        self._size = {}
+        self._matched = set()
+        self._lock = threading.Lock()
+
+    def _find(self, key):
+        root = key
+        while self._parent.get(root, root) != root:
+            root = self._parent[root]
+        while key != root:
+            self._parent[key], key = root, self._parent[key]
+        return root
+
+    def _union(self, first, second):
+        first, second = self._find(first), self._find(second)
+        if first == second:
+            return
+        if self._size.get(first, 1) > self._size.get(second, 1):
+            first, second = second, first
+        self._parent[first] = second
+        self._size[second] = self._size.get(first, 1) + \
+            self._size.get(second, 1)
+        if first in self._matched:
+            self._matched.discard(first)
+            self._matched.add(second)
+
+    def add(self, key, related, matched):
+        with self._lock:
+            for other in related:
+                self._union(key, other)
+            if matched:
+                self._matched.add(self._find(key))
+
+    def is_matched(self, key):
+        with self._lock:
+            return self._find(key) in self._matched
+
+
+def compile_filter_list(filters):
+    # cheap header tests run before body scans
+    compiled = [mfilter.compile() for mfilter in filters]
+    compiled.sort(key=lambda entry: entry[0])
+    return (sum([cost for cost, evaluate in compiled]),
+            [evaluate for cost, evaluate in compiled])
+
+
+class message_fields(object):
+    def __init__(self, message):
+        self._message = message
+        self._values = {}
+
+    def get(self, section):
+        if section in self._values:
+            return self._values[section]
+        if section == 'body':
+            value = message_body(self._message)
+        else:
+            value = self._message[section]
+        self._values[section] = value
+        return value
+
+    def timestamp(self):
+        if isinstance(self._message, archived_message):
+            return self._message.timestamp()
+        return None
 
 
 class match_filter(object):
@@ -191,8 +1717,13 @@ class match_filter(object):
         self._match_type = match_type
         self._match_data = match_data
         self._match_regex = False
+        self._regex = None
         if match_type != match_filter.REQUIRED_MATCH:
             self._match_regex = True
+            try:
+                self._regex = re.compile(match_data)
+            except (re.error, TypeError):
+                pass
 
     MATCH_TYPE_EXACT = 0
     MATCH_TYPE_PARTIAL = 1
@@ -202,15 +1733,87 @@ class match_filter(object):
     def length(self):
         return 0
 
+    def evaluator(self):
+        if getattr(self, '_evaluate', None) is None:
+            cost, self._evaluate = self.compile()
+        return self._evaluate
+
+    def compile(self):
+        section = self._mail_section
+        data = self._match_data
+        search = None
+        if self._regex is not None:
+            search = self._regex.search
+
+        cost = FILTER_COST_HEADER
+        if section == 'body':
+            cost = FILTER_COST_BODY
+        if search is not None:
+            cost += FILTER_COST_REGEX
+
+        if self._match_type == match_filter.REQUIRED_MATCH:
+            def evaluate(fields):
+                value = fields.get(section)
+                if value is NO_BODY_PART:
+                    return True
+                return value is not None and value == data
+        elif self._match_type == match_filter.NOT_REQUIRED_EXACT_MATCH:
+            def evaluate(fields):
+                value = fields.get(section)
+                if value is NO_BODY_PART:
+                    return True
+                if value is None:
+                    return False
+                # same outcome as part_match, cheapest test first
+                return value == data or data in value or \
+                    (search is not None and search(value) is not None)
+        else:
+            def evaluate(fields):
+                value = fields.get(section)
+                if value is NO_BODY_PART:
+                    return True
+                return self.part_match(value) != \
+                    match_filter.MATCH_TYPE_UNMATCHED
+        return cost, evaluate
+
+    def fields(self):
+        return set([self._mail_section.lower()])
+
+    def date_bounds(self):
+        return None, None
+
+    def index_candidates(self, terms):
+        if self._match_type == match_filter.REQUIRED_NOT_MATCH or \
+           self._match_data is None:
+            return None
+        candidates = term_candidates(terms, self._match_data)
+        if self._match_type == match_filter.REQUIRED_MATCH or \
+           candidates is None:
+            return candidates
+        # a partial match may come from the regex or the plain substring
+        literals = regex_literals(self._match_data)
+        if not literals:
+            return None
+        regex_candidates = None
+        for literal in literals:
+            found = term_candidates(terms, literal)
+            if found is None:
+                continue
+            if regex_candidates is None:
+                regex_candidates = found
+            else:
+                regex_candidates &= found
+        if regex_candidates is None:
+            return None
+        return candidates | regex_candidates
+
     def part_match(self, part_text):
         matching_type = None
 
         if part_text is not None and part_text == self._match_data:
             matching_type = match_filter.MATCH_TYPE_EXACT
-        elif self._match_regex and self._match_data is not None and \
-             part_text is not None:
-            result = re.findall(self._match_data, part_text)
-            if result is not None and len(result) > 0:
+        elif self._regex is not None and part_text is not None:
+            if self._regex.search(part_text) is not None:
                 matching_type = match_filter.MATCH_TYPE_REGEX
 
         if part_text is not None and matching_type is None and \
@@ -230,13 +1833,12 @@ class match_filter(object):
 
         return matching_type
 
-    def does_match(self, message, recur=False):
-        if recur or self._mail_section == 'body':
-            if message.is_multipart():
-                for part in message.get_payload():
-                    return self.does_match(part, True)
-            else:
-                return self.part_match(message.get_payload())
+    def does_match(self, message):
+        if self._mail_section == 'body':
+            body = message_body(message)
+            if body is NO_BODY_PART:
+                return None
+            return self.part_match(body)
         else:
             return self.part_match(message[self._mail_section])
 
@@ -251,15 +1853,34 @@ class date_filter(match_filter):
         self._mail_section = 'Date'
         self._before = before
 
+    def compile(self):
+        def evaluate(fields):
+            # messages from the header index come with the date parsed
+            timestamp = fields.timestamp()
+            if timestamp is not None:
+                return self.time_match(timestamp)
+            return self.part_match(fields.get('Date')) != \
+                match_filter.MATCH_TYPE_UNMATCHED
+        return FILTER_COST_DATE, evaluate
+
+    def index_candidates(self, terms):
+        return None
+
+    def date_bounds(self):
+        if self._before:
+            return None, self._match_data
+        return self._match_data, None
+
+    def time_match(self, date_to_check):
+        if self._before:
+            return self._match_data > date_to_check
+        return self._match_data <= date_to_check
+
     def part_match(self, date_string):
         date_to_check = email.utils.mktime_tz(
             email.utils.parsedate_tz(date_string))
-        if self._before:
-            if self._match_data > date_to_check:
-                return match_filter.MATCH_TYPE_EXACT
-        else:
-            if self._match_data <= date_to_check:
-                return match_filter.MATCH_TYPE_EXACT
+        if self.time_match(date_to_check):
+            return match_filter.MATCH_TYPE_EXACT
 
         return match_filter.MATCH_TYPE_UNMATCHED
 
@@ -274,6 +1895,43 @@ class and_filter(match_filter):
     def length(self):
         return len(self._filters)
 
+    def compile(self):
+        cost, evaluators = compile_filter_list(self._filters)
+        if len(evaluators) == 1:
+            return cost, evaluators[0]
+
+        def evaluate(fields):
+            for child in evaluators:
+                if not child(fields):
+                    return False
+            return True
+        return cost, evaluate
+
+    def fields(self):
+        return set().union(*[mfilter.fields() for mfilter in self._filters])
+
+    def index_candidates(self, terms):
+        candidates = None
+        for mfilter in self._filters:
+            found = mfilter.index_candidates(terms)
+            if found is None:
+                continue
+            if candidates is None:
+                candidates = found
+            else:
+                candidates &= found
+        return candidates
+
+    def date_bounds(self):
+        lower, upper = None, None
+        for mfilter in self._filters:
+            low, high = mfilter.date_bounds()
+            if low is not None and (lower is None or low > lower):
+                lower = low
+            if high is not None and (upper is None or high < upper):
+                upper = high
+        return lower, upper
+
     def part_match(self, part_text):
         for mfilter in self._filters:
             if mfilter.does_match(part_text) == \
@@ -286,25 +1944,64 @@ class and_filter(match_filter):
         return self.part_match(message)
 
 
+class thread_member_filter(match_filter):
+    def __init__(self, threads):
+        self._threads = threads
+
+    def fields(self):
+        return set(['message-id', 'from', 'date', 'subject'])
+
+    def index_candidates(self, terms):
+        return None
+
+    def compile(self):
+        def evaluate(fields):
+            return self._threads.is_matched(thread_key(fields))
+        return FILTER_COST_HEADER, evaluate
+
+    def does_match(self, message):
+        if self.evaluator()(message_fields(message)):
+            return match_filter.MATCH_TYPE_EXACT
+        return match_filter.MATCH_TYPE_UNMATCHED
+
+
 class threaded_and_filter(and_filter):
     def __init__(self, filter_list):
         self._filters = filter_list
-        self._replyto_ids = []
+        self._threads = thread_index()
 
-    def does_match(self, message):
-        result = self.part_match(message)
-        inreplyto = message['In-Reply-To']
-        if inreplyto is None:
+    def thread_filter(self):
+        # matches every message of a thread that had a match, once all
+        # archives went through this filter
+        return thread_member_filter(self._threads)
+
+    def fields(self):
+        return and_filter.fields(self) | \
+            set(['message-id', 'in-reply-to', 'references', 'from', 'date',
+                 'subject'])
+
+    def index_candidates(self, terms):
+        # replies are followed through every message, so nothing is skipped
+        return None
+
+    def date_bounds(self):
+        return None, None
+
+    def compile(self):
+        cost, matches = and_filter.compile(self)
+
+        def evaluate(fields):
+            result = matches(fields)
+            self._threads.add(thread_key(fields),
+                              message_ids(fields.get('In-Reply-To')) +
+                              message_ids(fields.get('References')), result)
             return result
-        if result is match_filter.MATCH_TYPE_UNMATCHED:
-            if inreplyto in self._replyto_ids:
-                result = match_filter.MATCH_TYPE_PARTIAL
-                self._replyto_ids.append(inreplyto)
-                print "added in-reply-to %s" % inreplyto
-        else:
-            self._replyto_ids.append(inreplyto)
-            print "added in-reply-to %s" % inreplyto
-        return result
+        return cost, evaluate
+
+    def does_match(self, message):
+        if self.evaluator()(message_fields(message)):
+            return match_filter.MATCH_TYPE_EXACT
+        return match_filter.MATCH_TYPE_UNMATCHED
 
 
 class or_filter(match_filter):
@@ -317,6 +2014,42 @@ class or_filter(match_filter):
     def length(self):
         return len(self._filters)
 
+    def compile(self):
+        cost, evaluators = compile_filter_list(self._filters)
+        if len(evaluators) == 1:
+            return cost, evaluators[0]
+
+        def evaluate(fields):
+            for child in evaluators:
+                if child(fields):
+                    return True
+            return False
+        return cost, evaluate
+
+    def fields(self):
+        return set().union(*[mfilter.fields() for mfilter in self._filters])
+
+    def index_candidates(self, terms):
+        candidates = set()
+        for mfilter in self._filters:
+            found = mfilter.index_candidates(terms)
+            if found is None:
+                return None
+            candidates |= found
+        return candidates
+
+    def date_bounds(self):
+        bounds = [mfilter.date_bounds() for mfilter in self._filters]
+        if not bounds or None in [low for low, high in bounds]:
+            lower = None
+        else:
+            lower = min([low for low, high in bounds])
+        if not bounds or None in [high for low, high in bounds]:
+            upper = None
+        else:
+            upper = max([high for low, high in bounds])
+        return lower, upper
+
     def part_match(self, part_text):
         for mfilter in self._filters:
             if mfilter.does_match(part_text) != \
@@ -329,17 +2062,671 @@ class or_filter(match_filter):
         return self.part_match(message)
 
 
-def mbox_messages_matching(ArchiveUrl, TopFilter):
-    mbx = get_mailman_mailbox_from_archive(ArchiveUrl)
-    matchingMsgs = []
-    for msgkey in mbx.iterkeys():
-        message = mbx[msgkey]
-        matched = TopFilter.does_match(message) != \
-            match_filter.MATCH_TYPE_UNMATCHED
-        if matched:
-            matchingMsgs.append(message)
+class batch_filter(or_filter):
+    def __init__(self, queries):
+        or_filter.__init__(self, [mfilter for name, mfilter in queries])
+        self._queries = queries
+        self._finished = set()
+
+    def finish(self, name):
+        self._finished.add(name)
+
+    def finished(self):
+        return len(self._finished) == len(self._queries)
+
+    def compile(self):
+        queries = [(name, mfilter.evaluator())
+                   for name, mfilter in self._queries]
+
+        def evaluate(fields):
+            return [name for name, matches in queries
+                    if name not in self._finished and matches(fields)]
+        return FILTER_COST_BODY, evaluate
+
+    def does_match(self, message):
+        if self.evaluator()(message_fields(message)):
+            return match_filter.MATCH_TYPE_EXACT
+        return match_filter.MATCH_TYPE_UNMATCHED
+
+
+def read_batch_file(path):
+    # one query per line: a name, then the filter words as they would be
+    # given on the command line
+    queries = []
+    with open(path, 'r') as fileop:
+        for line in fileop:
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            name = words[0].rstrip(':')
+            # the name becomes NAME.mbox in the -o directory
+            if not name or name in [known for known, q in queries] or \
+               os.path.basename(name) != name or name in ('.', '..'):
+                print "Bad or repeated query name [%s] in %s" % (name, path)
+                sys.exit(1)
+            if len(words) == 1:
+                print "Error: Query [%s] has no filters" % name
+                sys.exit(1)
+            queries.append((name, make_filters(words[1:])))
+    if not queries:
+        print "Error: No queries in %s" % path
+        sys.exit(1)
+    return queries
+
+
+class scan_checkpoint(object):
+    # how far a saved search got in every archive, and what it reported
+    # there; later runs under the same name start where it stopped and do
+    # not report a message again
+    def __init__(self):
+        self._path = None
+        self._key = None
+        self._resume = False
+        self._archives = {}
+        self._scanned = {}
+        self._lock = threading.Lock()
+
+    def enable(self, name, key, resume=True):
+        self._path = os.path.join(cache_directory(), CACHE_CHECKPOINTS,
+                                  re.sub('[/:@]+', '_', name))
+        # compared in the form it takes after a trip through json
+        self._key = json.loads(json.dumps(key))
+        self._resume = resume
+        try:
+            with open(self._path, 'r') as fileop:
+                stored = json.load(fileop)
+        except (IOError, OSError, ValueError):
+            return
+        if not isinstance(stored, dict) or \
+           stored.get('version') != CHECKPOINT_VERSION:
+            return
+        if stored.get('key') != self._key:
+            print >>diagnostics, "Checkpoint [%s] was saved for another " \
+                "search, starting over" % name
+            return
+        self._archives = stored.get('archives', {})
+        for state in self._archives.itervalues():
+            state['matched'] = set(state.get('matched', []))
+
+    def first(self, ArchiveUrl, mbx):
+        # the first message still to be looked at; the last one scanned is
+        # looked at again, since a sync may have appended to it
+        if self._path is None or not self._resume:
+            return 0
+        with self._lock:
+            state = self._archives.get(ArchiveUrl)
+        if state is None or 'position' not in state:
+            return 0
+        index = mbx.index()
+        position = state['position']
+        if position >= len(index['offsets']) or \
+           index['offsets'][position] != state['offset'] or \
+           index['headers']['message-id'][position] != state['message-id']:
+            # the archive was rewritten, so all of it is scanned again
+            return 0
+        if index['validator'] == state['validator']:
+            return len(index['offsets'])
+        return position
+
+    def reported(self, ArchiveUrl, message, query=None):
+        # whether a match was already reported, by this run or an earlier one
+        if self._path is None:
+            return False
+        key = thread_key(message_fields(message))
+        if query is not None:
+            key = '%s %s' % (query, key)
+        with self._lock:
+            state = self._archives.setdefault(ArchiveUrl, {})
+            matched = state.setdefault('matched', set())
+            if key in matched:
+                return True
+            matched.add(key)
+        return False
+
+    def scanned(self, ArchiveUrl, mbx):
+        if self._path is None:
+            return
+        index = mbx.index()
+        if not index['offsets']:
+            return
+        position = len(index['offsets']) - 1
+        with self._lock:
+            self._scanned[ArchiveUrl] = {
+                'position': position,
+                'offset': index['offsets'][position],
+                'message-id': index['headers']['message-id'][position],
+                'validator': index['validator']}
+
+    def delivered(self, ArchiveUrl):
+        # an archive only counts as scanned once all of its matches were
+        # handed out, which with -j may be well after the scan itself
+        with self._lock:
+            scanned = self._scanned.pop(ArchiveUrl, None)
+            if scanned is not None:
+                self._archives.setdefault(ArchiveUrl, {}).update(scanned)
+
+    def save(self):
+        if self._path is None:
+            return
+        if not os.path.isdir(os.path.dirname(self._path)):
+            os.makedirs(os.path.dirname(self._path))
+        tmpname = cache_tmpname(self._path)
+        with self._lock:
+            archives = {}
+            for ArchiveUrl, state in self._archives.iteritems():
+                archives[ArchiveUrl] = dict(state)
+                archives[ArchiveUrl]['matched'] = \
+                    sorted(state.get('matched', []))
+            stored = {'version': CHECKPOINT_VERSION, 'key': self._key,
+                      'archives': archives}
+            with open(tmpname, 'w') as fileop:
+                json.dump(stored, fileop)
+        os.rename(tmpname, self._path)
+
+
+run_checkpoint = scan_checkpoint()
+
+
+def archive_candidates(mbx, TopFilter, use_terms=False, first=0):
+    fields = TopFilter.fields()
+    # without body filters only the header block of a message is parsed,
+    # the rest waits until a match is written out
+    headers_only = 'body' not in fields
+    candidates = None
+    if use_terms:
+        candidates = TopFilter.index_candidates(mbx.terms())
+    if candidates is not None:
+        messages = mbx.iterindexed(sorted(position for position in candidates
+                                          if position >= first),
+                                   headers_only)
+    elif first:
+        messages = mbx.iterindexed(xrange(first, len(mbx.index()['offsets'])),
+                                   headers_only)
+    elif fields.issubset(INDEXED_FIELDS):
+        messages = mbx.iterindexed()
+    else:
+        messages = mbx.itermessages(headers_only)
+    return messages
+
+
+def mbox_messages_matching(ArchiveUrl, TopFilter, mbx, use_terms=False):
+    evaluate = TopFilter.evaluator()
+    archive = stats_archive_name(ArchiveUrl)
+    first = run_checkpoint.first(ArchiveUrl, mbx)
+    # matches are handed out as soon as they are found, so a caller that
+    # stops early never parses the rest of the archive
+    examined = 0
+    started = time.time()
+    for message in archive_candidates(mbx, TopFilter, use_terms, first):
+        check_cancelled()
+        examined += 1
+        if evaluate(message_fields(message)):
+            run_stats.add('match', time.time() - started, 0, examined,
+                          archive)
+            run_stats.count('matches')
+            examined = 0
+            yield message
+            started = time.time()
+    run_stats.add('match', time.time() - started, 0, examined, archive)
+    run_checkpoint.scanned(ArchiveUrl, mbx)
+
+
+def mbox_batch_matching(ArchiveUrl, TopFilter, mbx, use_terms=False):
+    # every message is parsed once and offered to all queries of the batch,
+    # a message matching several of them is handed out once per query
+    evaluate = TopFilter.evaluator()
+    archive = stats_archive_name(ArchiveUrl)
+    first = run_checkpoint.first(ArchiveUrl, mbx)
+    examined = 0
+    started = time.time()
+    for message in archive_candidates(mbx, TopFilter, use_terms, first):
+        check_cancelled()
+        examined += 1
+        names = evaluate(message_fields(message))
+        if not names:
+            continue
+        run_stats.add('match', time.time() - started, 0, examined, archive)
+        run_stats.count('matches', len(names))
+        examined = 0
+        for name in names:
+            yield name, message
+        started = time.time()
+    run_stats.add('match', time.time() - started, 0, examined, archive)
+    run_checkpoint.scanned(ArchiveUrl, mbx)
+
+
+class scan_cancelled(Exception):
+    pass
+
+
+def check_cancelled():
+    # lets a pool worker give up on an archive nobody will look at anymore
+    cancelled = getattr(threading.current_thread(), 'cancelled', None)
+    if cancelled is not None and cancelled.is_set():
+        raise scan_cancelled()
+
+
+class pending_result(object):
+    def __init__(self, func, args):
+        self._func = func
+        self._args = args
+        self._done = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._value = self._func(*self._args)
+        except:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        # wait in slices so that ^C still reaches the main thread
+        while not self._done.wait(0.5):
+            pass
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+class worker_pool(object):
+    def __init__(self, jobs):
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._cancelled = threading.Event()
+        for i in range(jobs):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.cancelled = self._cancelled
+            worker.start()
+            self._threads.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            task.run()
+
+    def submit(self, func, *args):
+        task = pending_result(func, args)
+        self._tasks.put(task)
+        return task
+
+    def close(self):
+        # drop work nobody will collect, tell the archives in flight to stop
+        # at their next stage, then let the workers wind down
+        self._cancelled.set()
+        try:
+            while True:
+                self._tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for worker in self._threads:
+            self._tasks.put(None)
+        for worker in self._threads:
+            worker.join()
+
+
+def ordered_map(func, items, jobs):
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # keep a bounded window of archives in flight, and hand the results
+    # back in submission order so that output stays newest-first
+    pool = worker_pool(jobs)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.submit(func, item))
+            while pending and (len(pending) >= jobs * 2 or
+                               pending[0].done()):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.close()
+
+
+class match_stream(object):
+    # the matches of one archive, found on a pool worker and handed over
+    # while it goes on; the queue is bounded so that a worker does not run
+    # far ahead of the output
+    def __init__(self, depth=MATCH_QUEUE_DEPTH):
+        self._queue = Queue.Queue(depth)
+        self._ready = threading.Event()
+        self._head = None
+        self._exc_info = None
+
+    def run(self, func, item):
+        try:
+            result = func(item)
+            self._head = result[:-1]
+            self._ready.set()
+            for message in result[-1] or []:
+                self._put(message)
+        except scan_cancelled:
+            raise
+        except:
+            self._exc_info = sys.exc_info()
+        self._ready.set()
+        self._put(None)
+
+    def _put(self, entry):
+        # gives up once nobody is going to read the rest
+        while True:
+            check_cancelled()
+            try:
+                self._queue.put(entry, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def ready(self):
+        return self._ready.is_set()
+
+    def _messages(self):
+        while True:
+            try:
+                entry = self._queue.get(True, 0.5)
+            except Queue.Empty:
+                continue
+            if entry is None:
+                break
+            yield entry
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def result(self):
+        # wait in slices so that ^C still reaches the main thread
+        while not self._ready.wait(0.5):
+            pass
+        if self._head is None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._head + (self._messages(),)
+
+
+def ordered_scan(func, items, jobs):
+    # ordered_map for searches: func returns its matches last, and they
+    # are found on the workers as well, so matching runs in parallel too
+    # while the output keeps the order of items
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = worker_pool(jobs)
+    pending = collections.deque()
+    try:
+        for item in items:
+            stream = match_stream()
+            pool.submit(stream.run, func, item)
+            pending.append(stream)
+            while pending and (len(pending) >= jobs * 2 or
+                               pending[0].ready()):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        pool.close()
+
+
+def archive_url_map(ArchiveUrl, mbx):
+    # the thread page is cached like the archive itself, and parsed once
+    # into a map from Message-ID, subject and sender to message pages
+    try:
+        page_path = cached_url_fetch(ArchiveUrl.replace('.txt.gz',
+                                                        '/thread.html'))
+        return mbx.urls(page_path)
+    except:
+        return None
 
-    return matchingMsgs
+
+def scan_archive(BaseUrl, arch, TopFilter, find_mailman_url=False,
+                 prefetch_only=False, use_terms=False, cached_only=False):
+    url_map = None
+    check_cancelled()
+    mbx = get_mailman_mailbox_from_archive(BaseUrl + arch, cached_only)
+    check_cancelled()
+    if find_mailman_url and mbx is not None:
+        url_map = archive_url_map(BaseUrl + arch, mbx)
+    if use_terms and mbx is not None:
+        mbx.terms()
+    if prefetch_only:
+        return arch, url_map, mbx
+    if mbx is None:
+        # the archive could not be fetched, and was already reported
+        return arch, url_map, iter(())
+    if not TopFilter.fields().issubset(INDEXED_FIELDS) \
+       and run_checkpoint.first(BaseUrl + arch, mbx) < \
+            len(mbx.index()['offsets']):
+        # inflate the archive here, while still on a pool worker
+        mbx.buffer()
+    if isinstance(TopFilter, batch_filter):
+        return arch, url_map, mbox_batch_matching(BaseUrl + arch, TopFilter,
+                                                  mbx, use_terms)
+    return arch, url_map, mbox_messages_matching(BaseUrl + arch, TopFilter,
+                                                 mbx, use_terms)
+
+
+def archive_list_url(name):
+    if os.getenv('SMA_ARCHIVE_URL') and not (name.find("http://") == 0 or
+                                             name.find("https://") == 0):
+        MailMan, instances = re.subn("/mailman(/listinfo)?/?$", "/archives/",
+                                     os.getenv('SMA_ARCHIVE_URL'))
+        return MailMan + name + "/"
+    return name
+
+
+def merge_archive_lists(listed):
+    # the archives of every list as (BaseUrl, arch), newest volume first;
+    # volumes of the same period follow the order the lists were given in
+    merged = []
+    for order, (BaseUrl, archives) in enumerate(listed):
+        for position, arch in enumerate(archives):
+            period = archive_period(arch)
+            if period is None:
+                age = (1, order, position)
+            else:
+                age = (0, -period[1], -period[0], order, position)
+            merged.append((age, (BaseUrl, arch)))
+    merged.sort()
+    return [entry[1] for entry in merged]
+
+
+def archive_columns(archives, jobs):
+    # the header index of every cached archive, as one numpy column per
+    # field; archives not cached yet are fetched first
+    def load(item):
+        mbx = get_mailman_mailbox_from_archive(item[0] + item[1], True)
+        if mbx is None:
+            return item, None
+        return item, mbx.index()
+
+    lists = []
+    numbers, timestamps = [], []
+    senders, subjects, ids, parents = [], [], [], []
+    for (BaseUrl, arch), index in ordered_map(load, archives, jobs):
+        if index is None:
+            continue
+        if BaseUrl not in lists:
+            lists.append(BaseUrl)
+        count = len(index['offsets'])
+        numbers.append(numpy.repeat(lists.index(BaseUrl), count))
+        timestamps.append(numpy.frombuffer(index['timestamps'].tostring(),
+                                           dtype=numpy.float64))
+        headers = index['headers']
+        senders.extend(sender or '' for sender in headers['from'])
+        subjects.extend(subject or '' for subject in headers['subject'])
+        ids.extend((message_ids(value) or [''])[0]
+                   for value in headers['message-id'])
+        parents.extend((message_ids(value) or [''])[0]
+                       for value in headers['in-reply-to'])
+
+    if not timestamps:
+        return None
+    # pipermail writes senders as "user at host (Name)"
+    senders = numpy.array(senders, dtype=str)
+    if len(senders):
+        senders = numpy.char.lower(numpy.char.strip(numpy.char.partition(
+            senders, ' (')[:, 0]))
+    senders[senders == ''] = '(unknown)'
+    return {'lists': numpy.array(lists, dtype=object),
+            'list': numpy.concatenate(numbers),
+            'timestamp': numpy.concatenate(timestamps),
+            'sender': senders,
+            'subject': numpy.array(subjects, dtype=str),
+            'message-id': numpy.array(ids, dtype=str),
+            'in-reply-to': numpy.array(parents, dtype=str)}
+
+
+def patch_number(subject):
+    subject = subject.replace('\r', ' ').replace('\n', ' ').replace('\t', '')
+    match = __patch_id.match(subject)
+    if match:
+        return int(match.group('patch_num'))
+    if SINGLE_PATCH_RE.match(subject):
+        return 1
+    return -1
+
+
+def patch_columns(subjects, parents):
+    # the patch number of every message (-1 for anything but a patch) and
+    # whether it starts a series: a cover letter, or the first patch when
+    # it does not answer one. Replies and resends share subjects, so the
+    # patterns only run once per distinct subject that opens with a tag
+    values, inverse = numpy.unique(subjects, return_inverse=True)
+    numbers = numpy.full(len(values), -1, dtype=numpy.int32)
+    tagged = numpy.flatnonzero(numpy.char.startswith(
+        numpy.char.lstrip(values, '\t'), '['))
+    numbers[tagged] = numpy.fromiter((patch_number(value)
+                                      for value in values[tagged]),
+                                     dtype=numpy.int32, count=len(tagged))
+    numbers = numbers[inverse]
+    starts = (numbers == 0) | ((numbers == 1) & (parents == ''))
+    return numbers, starts
+
+
+def reply_latency(columns):
+    # hours from each message to the reply, for the replies whose parent
+    # is in the cache too
+    ids = columns['message-id']
+    if not len(ids):
+        return numpy.zeros(0, dtype=bool), numpy.zeros(0)
+    order = numpy.argsort(ids, kind='mergesort')
+    found = numpy.searchsorted(ids[order], columns['in-reply-to'])
+    found = numpy.minimum(found, len(ids) - 1)
+    parent = order[found]
+    replies = (columns['in-reply-to'] != '') & \
+        (ids[parent] == columns['in-reply-to'])
+    latency = (columns['timestamp'] - columns['timestamp'][parent]) / 3600.0
+    return replies & (latency >= 0), latency
+
+
+def key_column(columns, key):
+    timestamps = columns['timestamp']
+    days = numpy.floor(timestamps / 86400).astype(numpy.int64)
+    if key == 'list':
+        return columns['list']
+    elif key == 'sender':
+        return columns['sender']
+    elif key == 'year':
+        return timestamps.astype('datetime64[s]').astype('datetime64[Y]')
+    elif key == 'month':
+        return timestamps.astype('datetime64[s]').astype('datetime64[M]')
+    elif key == 'week':
+        # weeks start on monday; 1970-01-01 was a thursday
+        return (days - (days + 3) % 7).astype('datetime64[D]')
+    elif key == 'weekday':
+        return (days + 3) % 7
+    return numpy.floor(timestamps % 86400 / 3600).astype(numpy.int64)
+
+
+def key_label(columns, key, value):
+    if key == 'list':
+        return columns['lists'][value]
+    elif key == 'weekday':
+        return WEEKDAY_NAMES[value]
+    elif key == 'hour':
+        return int(value)
+    elif key == 'sender':
+        return value
+    return str(value)
+
+
+def list_report(columns, measure, keys, top=None):
+    # group the rows selected by measure by the keys, all in numpy
+    selected = numpy.ones(len(columns['timestamp']), dtype=bool)
+    if measure in ('patches', 'series'):
+        numbers, starts = patch_columns(columns['subject'],
+                                        columns['in-reply-to'])
+        selected = starts if measure == 'series' else numbers >= 0
+    elif measure == 'latency':
+        selected, latency = reply_latency(columns)
+    if set(keys) - set(['list', 'sender']):
+        selected &= ~numpy.isnan(columns['timestamp'])
+
+    group = numpy.zeros(numpy.count_nonzero(selected), dtype=numpy.int64)
+    uniques = []
+    for key in keys:
+        values, inverse = numpy.unique(key_column(columns, key)[selected],
+                                       return_inverse=True)
+        uniques.append(values)
+        group = group * len(values) + inverse
+    groups, inverse = numpy.unique(group, return_inverse=True)
+    counts = numpy.bincount(inverse, minlength=len(groups))
+
+    header = list(keys) + [measure if measure != 'latency' else 'replies']
+    extra = []
+    if measure == 'latency':
+        header += ['median_hours', 'mean_hours', 'p90_hours']
+        hours = latency[selected]
+        order = numpy.lexsort((hours, inverse))
+        hours = hours[order]
+        starts = numpy.cumsum(counts) - counts
+        median = (hours[starts + (counts - 1) // 2] +
+                  hours[starts + counts // 2]) / 2
+        mean = numpy.bincount(inverse, weights=latency[selected],
+                              minlength=len(groups)) / numpy.maximum(counts, 1)
+        p90 = hours[starts + ((counts - 1) * 0.9).astype(numpy.int64)]
+        extra = [numpy.round(median, 2), numpy.round(mean, 2),
+                 numpy.round(p90, 2)]
+
+    rows = numpy.arange(len(groups))
+    if top is not None:
+        # the largest groups, ties in key order
+        rows = numpy.argsort(-counts, kind='mergesort')[:top]
+
+    table = []
+    for row in rows:
+        labels = []
+        remaining = groups[row]
+        for key, values in reversed(zip(keys, uniques)):
+            remaining, position = divmod(remaining, len(values))
+            labels.insert(0, key_label(columns, key, values[position]))
+        table.append(labels + [int(counts[row])] +
+                     [float(column[row]) for column in extra])
+    return header, table
+
+
+def print_list_report(header, table, output_format):
+    if output_format == 'json':
+        json.dump([dict(zip(header, row)) for row in table], sys.stdout,
+                  indent=1)
+        print
+        return
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(header)
+    for row in table:
+        writer.writerow([value.encode('utf-8')
+                         if isinstance(value, unicode) else value
+                         for value in row])
 
 
 def string_match_in_list(string, lst):
@@ -450,11 +2837,45 @@ def make_filters(argslist, threaded_search=False):
         print "Error: Must have at least one filter"
         sys.exit(1)
 
+    return_filter.evaluator()
     return return_filter
 
 
+def report_words(args):
+    return [word for arg in args for word in arg.split(',') if word]
+
+
+def command_word(args):
+    # a list may be named like a command; the word is only taken as one
+    # when the rest of the line is what that command takes
+    if not args or args[0] not in COMMANDS:
+        return None
+    rest = args[1:]
+    if not rest:
+        return args[0]
+    if args[0] == 'cache':
+        if rest in (['stats'], ['trim']):
+            return 'cache'
+        return None
+    if '://' in rest[0]:
+        return args[0]
+    words = report_words(rest[1:])
+    if args[0] == 'sync':
+        if not words:
+            return 'sync'
+        return None
+    if [word for word in words
+        if word not in REPORT_MEASURES + REPORT_KEYS + ('by',)]:
+        return None
+    return 'report'
+
+
 def usage():
-    print "Usage: %s [OPTIONS] ARCHIVE FILTER..." % sys.argv[0]
+    print "Usage: %s [OPTIONS] ARCHIVE[,ARCHIVE...] FILTER..." % sys.argv[0]
+    print "       %s [OPTIONS] sync ARCHIVE[,ARCHIVE...]" % sys.argv[0]
+    print "       %s cache stats|trim" % sys.argv[0]
+    print "       %s [OPTIONS] report ARCHIVE[,ARCHIVE...] [MEASURE] [by KEY...]" \
+        % sys.argv[0]
     print "Search mailman archives"
     print "Entries are reported in time descending order (most recent first)"
     print ""
@@ -462,10 +2883,32 @@ def usage():
     print " -a                        Accept all SSL Certificates"
     print " -c                        Clear archive cache instead of search"
     print " -d                        Dump matching messages in mbox format"
+    print " --jsonl                   Print each match as a line of JSON, with"
+    print "                           where it is in the cached archive"
+    print " -e [CMD]                  Run CMD with each match on its stdin"
+    print " --exec-workers [NUM]      Keep NUM copies of CMD running and stream"
+    print "                           matches to them"
+    print " --exec-framing [FORMAT]   How streamed matches are separated: 'mbox'"
+    print "                           (the default) or 'length'"
     print " -l [USER:PASSWORD]        Set login information"
     print " -m [NUM]                  Match only NUM messages and then exit"
+    print " -j [NUM]                  Fetch and scan NUM archives in parallel"
+    print " --host-jobs [NUM]         Send at most NUM requests to one server at"
+    print "                           a time"
+    print " --index                   Build and use a term index of the cache"
+    print " --batch [FILE]            Run every named query in FILE in one pass"
+    print " --serve [ADDRESS]         Answer queries over HTTP on [HOST:]PORT, or"
+    print "                           on a unix socket when ADDRESS is a path"
+    print " --refresh [SECONDS]       How often --serve refreshes the archives"
+    print " --stats                   Report time spent per stage and archive"
+    print " --stats-json [PATH]       Write that report as JSON to PATH (or -)"
+    print " --profile [PATH]          Save a cProfile dump of the run to PATH"
+    print " --checkpoint [NAME]       Only scan and report what is new since the"
+    print "                           last search saved under NAME"
+    print " --top [NUM]               report: only the NUM largest groups"
+    print " --format [FORMAT]         report: 'csv' (the default) or 'json'"
     print " -o [PATH]                 Save off matches to the path specified"
-    print " -u                        Seek the Mailman URL for this message (net only)"
+    print " -u                        Seek the Mailman URL for this message"
     print " -t                        Threaded searching (tries to follow replies)"
     print " -h                        This help message"
     print ""
@@ -489,6 +2932,338 @@ def usage():
     print "apply to every filter specified AFTER their appearance."
 
 
+def mbox_bytes(message):
+    # the cached archive already holds the message in mbox form, so it is
+    # copied out as is instead of being parsed and flattened again
+    data = message.raw()
+    if not data.endswith('\n'):
+        data += '\n'
+    if not data.endswith('\n\n'):
+        data += '\n'
+    return data
+
+
+class mbox_writer(object):
+    def __init__(self, batch_size=OUTPUT_BATCH_SIZE,
+                 open_files=OUTPUT_OPEN_FILES):
+        self._batch_size = batch_size
+        self._open_files = open_files
+        self._pending = collections.OrderedDict()
+        self._pending_size = 0
+        self._files = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _handle(self, path):
+        fileop = self._files.pop(path, None)
+        if fileop is None:
+            if len(self._files) >= self._open_files:
+                oldest, old = self._files.popitem(last=False)
+                old.close()
+            fileop = open(path, 'ab+')
+            # keep the blank line that separates messages when appending
+            # to a mailbox that was cut short
+            fileop.seek(0, 2)
+            if fileop.tell() >= 2:
+                fileop.seek(-2, 2)
+                tail = fileop.read(2)
+                fileop.seek(0, 2)
+                if tail != '\n\n':
+                    fileop.write('\n' if tail[1] == '\n' else '\n\n')
+            elif fileop.tell() == 1:
+                fileop.write('\n')
+        self._files[path] = fileop
+        return fileop
+
+    def _flush(self):
+        for path, chunks in self._pending.iteritems():
+            fileop = self._handle(path)
+            fileop.write(''.join(chunks))
+            fileop.flush()
+        self._pending.clear()
+        self._pending_size = 0
+
+    def open(self, path):
+        with self._lock:
+            self._handle(path)
+
+    def add(self, path, message):
+        data = mbox_bytes(message)
+        with self._lock:
+            if path not in self._pending:
+                self._pending[path] = []
+            self._pending[path].append(data)
+            self._pending_size += len(data)
+            if self._pending_size >= self._batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            while self._files:
+                path, fileop = self._files.popitem()
+                fileop.close()
+
+
+class exec_pool(object):
+    def __init__(self, command, workers=1, framing='mbox'):
+        self._command = command
+        self._framing = framing
+        # a bounded queue lets the search run ahead of the command, but only
+        # so far: once it is full, scanning waits for the command to catch up
+        self._queue = Queue.Queue(EXEC_QUEUE_DEPTH)
+        self._threads = []
+        for i in range(workers):
+            proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+            worker = threading.Thread(target=self._work, args=(proc,))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def _work(self, proc):
+        failed = False
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if failed:
+                continue
+            try:
+                proc.stdin.write(data)
+            except IOError, e:
+                # keep draining, so that the search is never stuck behind a
+                # command which went away
+                print >>diagnostics, "Exec command [%s] stopped: %s" % \
+                    (self._command, e)
+                failed = True
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+
+    def _put(self, data):
+        # wait in slices so that ^C still reaches the main thread
+        while True:
+            try:
+                self._queue.put(data, True, 0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def add(self, message):
+        data = mbox_bytes(message)
+        if self._framing == 'length':
+            data = '%d\n%s' % (len(data), data)
+        self._put(data)
+
+    def close(self):
+        for worker in self._threads:
+            self._put(None)
+        for worker in self._threads:
+            worker.join()
+
+
+def json_text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+class archive_store(object):
+    # the mailboxes of one list, kept open along with their indexes so that
+    # queries only pay for the matching itself
+    def __init__(self, BaseUrl, jobs=1, use_terms=False):
+        self._base = BaseUrl
+        self._jobs = jobs
+        self._use_terms = use_terms
+        self._archives = []
+        self._mailboxes = {}
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        archives = mailman_archives(self._base)
+        with self._lock:
+            previous = self._mailboxes
+        mailboxes = {}
+        for arch, url_map, mbx in \
+                ordered_map(lambda arch: scan_archive(self._base, arch, None,
+                                                      False, True,
+                                                      self._use_terms),
+                            archives, self._jobs):
+            if mbx is None:
+                continue
+            old = previous.get(arch)
+            # an unchanged archive keeps its mapping and loaded indexes
+            if old is not None and \
+               old.index()['validator'] == mbx.index()['validator']:
+                mbx = old
+            mailboxes[arch] = mbx
+        with self._lock:
+            self._archives = [arch for arch in archives if arch in mailboxes]
+            self._mailboxes = mailboxes
+            self._refreshed = time.time()
+        cache_access.save()
+
+    def archives(self):
+        with self._lock:
+            return [{'archive': arch,
+                     'messages': len(self._mailboxes[arch].index()['offsets'])}
+                    for arch in self._archives], self._refreshed
+
+    def search(self, words, limit=SERVER_MATCH_LIMIT):
+        filters = make_filters(words)
+        bounds = filters.date_bounds()
+        with self._lock:
+            archives = list(self._archives)
+            mailboxes = self._mailboxes
+        matches = []
+        for arch in archives:
+            if not archive_may_match(arch, bounds):
+                continue
+            for message in mbox_messages_matching(self._base + arch, filters,
+                                                  mailboxes[arch],
+                                                  self._use_terms):
+                found = {'archive': arch,
+                         'offset': message.offset(),
+                         'length': message.length()}
+                for field in ('from', 'subject', 'date', 'message-id'):
+                    found[field] = json_text(message[field])
+                matches.append(found)
+                if len(matches) >= limit:
+                    return matches
+        return matches
+
+    def message(self, arch, offset):
+        with self._lock:
+            mbx = self._mailboxes.get(arch)
+        if mbx is None:
+            return None
+        index = mbx.index()
+        try:
+            position = index['offsets'].index(offset)
+        except ValueError:
+            return None
+        return mbox_bytes(indexed_message(mbx, index, position))
+
+
+class query_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def reply(self, code, body, content_type='application/json'):
+        if content_type == 'application/json':
+            body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def search(self, words, limit):
+        try:
+            matches = self.server.store.search(words, limit)
+        except SystemExit:
+            # make_filters bails out through sys.exit on a bad filter
+            self.reply(400, {'error': 'bad filter: %s' % ' '.join(words)})
+            return
+        except Exception, e:
+            self.reply(400, {'error': str(e)})
+            return
+        self.reply(200, {'matches': matches})
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        if url.path == '/search':
+            try:
+                words = shlex.split(params.get('q', [''])[0])
+                limit = int(params.get('limit', [SERVER_MATCH_LIMIT])[0])
+            except ValueError:
+                self.reply(400, {'error': 'bad query'})
+                return
+            self.search(words, limit)
+        elif url.path == '/archives':
+            archives, refreshed = self.server.store.archives()
+            self.reply(200, {'archives': archives, 'refreshed': refreshed})
+        elif url.path == '/message':
+            try:
+                data = self.server.store.message(params['archive'][0],
+                                                 int(params['offset'][0]))
+            except (KeyError, ValueError):
+                data = None
+            if data is None:
+                self.reply(404, {'error': 'no such message'})
+            else:
+                self.reply(200, data, 'application/mbox')
+        else:
+            self.reply(404, {'error': 'unknown path %s' % url.path})
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/search':
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(
+                int(self.headers.getheader('content-length', 0))))
+            words = request.get('filters')
+            if words is None:
+                words = shlex.split(request.get('q', '').encode('utf-8'))
+            words = [word.encode('utf-8') if isinstance(word, unicode)
+                     else word for word in words]
+            limit = int(request.get('limit', SERVER_MATCH_LIMIT))
+        except (ValueError, TypeError, AttributeError):
+            self.reply(400, {'error': 'bad request'})
+            return
+        self.search(words, limit)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class query_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class unix_query_server(SocketServer.ThreadingMixIn,
+                        SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_queries(address, store, refresh=SERVER_REFRESH):
+    # a path is served as a unix socket, anything else as [HOST:]PORT
+    if '/' in address:
+        if os.path.exists(address):
+            os.remove(address)
+        server = unix_query_server(address, query_handler)
+    else:
+        host, sep, port = address.rpartition(':')
+        server = query_server((host or '127.0.0.1', int(port)),
+                              query_handler)
+    server.store = store
+
+    def refresher():
+        while True:
+            time.sleep(refresh)
+            try:
+                store.refresh()
+            except Exception, e:
+                print "Refresh failed: %s" % e
+
+    worker = threading.Thread(target=refresher)
+    worker.daemon = True
+    worker.start()
+
+    print "Serving queries on %s" % address
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if '/' in address and os.path.exists(address):
+            os.remove(address)
+
+
 def conv_subj(subject, match):
     if match:
         real_subj = match.group('patch_subj')
@@ -498,11 +3273,58 @@ def conv_subj(subject, match):
         replace('\\', '_').replace('*', '_')
 
 
+def match_record(BaseUrl, arch, message, subj, query=None, urls=None):
+    # one --jsonl line: the headers of a match and where its bytes are in
+    # the cached archive, counted in the archive once inflated
+    fs_converted_url = cached_url_filename(BaseUrl + arch)
+    record = {'list': json_text(BaseUrl),
+              'archive': json_text(BaseUrl + arch),
+              'cache': json_text(fs_converted_url),
+              'compression': cached_archive_compression(fs_converted_url),
+              'offset': message.offset(),
+              'length': message.length(),
+              'headers': [[json_text(name), json_text(value)]
+                          for name, value in message.headers().items()],
+              'patch': None,
+              'patches': None,
+              'series': None}
+    for field in ('from', 'subject', 'date', 'message-id'):
+        record[field] = json_text(message[field])
+    if query is not None:
+        record['query'] = json_text(query)
+    if urls is not None:
+        record['urls'] = [json_text(url) for url in urls]
+
+    match = __patch_id.match(subj)
+    if match:
+        record['patch'] = int(match.group('patch_num'))
+        record['patches'] = int(match.group(2))
+    elif SINGLE_PATCH_RE.match(subj):
+        record['patch'], record['patches'] = 1, 1
+    if record['patch'] is not None:
+        # a series is named after the Message-ID of its first mail, which
+        # the rest of the series refers back to
+        parents = message_ids(message['references']) or \
+            message_ids(message['in-reply-to'])
+        if record['patch'] == 0 or not parents:
+            parents = message_ids(message['message-id'])
+        record['series'] = json_text((parents or [None])[0])
+    return json.dumps(record, sort_keys=True)
+
+
 def run_main():
     global login_user, login_pass, accept_all_certs, thread_replies_is
+    global host_jobs, diagnostics
     mbx = None
+    mbx_path = None
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'l:o:e:m:achtud')
+        optlist, args = getopt.getopt(sys.argv[1:], 'l:o:e:m:j:achtud',
+                                      ['index', 'exec-workers=',
+                                       'exec-framing=', 'batch=', 'serve=',
+                                       'refresh=', 'stats', 'stats-json=',
+                                       'profile=', 'checkpoint=',
+                                       'host-jobs=', 'top=', 'format=',
+                                       'jsonl'])
     except:
         print "Failed to getopt: %s" % (' '.join(sys.argv[1:]))
         sys.exit(1)
@@ -514,11 +3336,26 @@ def run_main():
     exec_arg = None
     match_total = -1
     dump_msgs = False
+    jobs = 1
+    use_terms = False
+    exec_workers = 0
+    exec_framing = None
+    exec_stream = None
+    batch_file = None
+    mbx_dir = None
+    serve_address = None
+    refresh = SERVER_REFRESH
+    checkpoint = None
+    top = None
+    output_format = 'csv'
+    jsonl = False
 
     for o, a in optlist:
         if o == '-o':
+            mbx = mbox_writer()
             if not os.path.isdir(a):
-                mbx = mailbox.mbox(a)
+                mbx_path = a
+                mbx.open(a)
             else:
                 mbx_dir = a
                 individual_files = True
@@ -537,6 +3374,8 @@ def run_main():
             dump_msgs = True
         elif o == '-m':
             match_total = int(a)
+        elif o == '-j':
+            jobs = int(a)
         elif o == '-h':
             usage()
             sys.exit(0)
@@ -544,11 +3383,64 @@ def run_main():
             threaded_search = True
         elif o == '-u':
             find_mailman_url = True
+        elif o == '--index':
+            use_terms = True
+        elif o == '--exec-workers':
+            exec_workers = int(a)
+        elif o == '--exec-framing':
+            if a not in EXEC_FRAMINGS:
+                print "Unknown framing [%s]" % a
+                sys.exit(1)
+            exec_framing = a
+        elif o == '--batch':
+            batch_file = a
+        elif o == '--serve':
+            serve_address = a
+        elif o == '--refresh':
+            refresh = int(a)
+        elif o == '--stats':
+            run_stats.enable()
+        elif o == '--stats-json':
+            run_stats.enable(a)
+        elif o == '--profile':
+            run_stats.profile(a)
+        elif o == '--checkpoint':
+            checkpoint = a
+        elif o == '--host-jobs':
+            host_jobs = max(int(a), 1)
+        elif o == '--top':
+            top = int(a)
+        elif o == '--format':
+            if a not in REPORT_FORMATS:
+                print "Unknown format [%s]" % a
+                sys.exit(1)
+            output_format = a
+        elif o == '--jsonl':
+            jsonl = True
+            diagnostics = sys.stderr
+
+    command = command_word(args)
+    if command is not None:
+        args.pop(0)
+
+    if command == 'cache':
+        if args == ['stats']:
+            cache_stats()
+        elif args == ['trim'] and cache_budget() is not None:
+            trim_cache(cache_budget(), False)
+        else:
+            usage()
+            sys.exit(1)
+        sys.exit(0)
 
     if len(args) == 0:
         usage()
         sys.exit(1)
 
+    if jsonl and dump_msgs:
+        print "Error: -d and --jsonl both write to standard output"
+        sys.exit(1)
+
     if os.getenv('SMA_LOGIN_USER'):
         login_user = os.getenv('SMA_LOGIN_USER')
     if os.getenv('SMA_LOGIN_PASSWORD'):
@@ -557,98 +3449,227 @@ def run_main():
     found_message = False
     filters = None
 
-    BaseUrl = args[0]
+    # several lists may be given, separated by commas
+    BaseUrls = [archive_list_url(name) for name in args[0].split(',')
+                if name]
+    if not BaseUrls:
+        usage()
+        sys.exit(1)
 
-    if os.getenv('SMA_ARCHIVE_URL') and not (BaseUrl.find("http://") == 0 or
-                                             BaseUrl.find("https://") == 0):
-        MailMan, instances = re.subn("/mailman(/listinfo)?/?$", "/archives/",
-                                     os.getenv('SMA_ARCHIVE_URL'))
-        BaseUrl = MailMan + args[0] + "/"
+    if serve_address is not None:
+        if len(BaseUrls) > 1:
+            print "Error: --serve takes a single list"
+            sys.exit(1)
+        store = archive_store(BaseUrls[0], jobs, use_terms)
+        store.refresh()
+        serve_queries(serve_address, store, refresh)
+        sys.exit(0)
 
-    for arch in mailman_archives(BaseUrl):
-        if find_mailman_url:
-            try:
-                archive_list = url_open(
-                    BaseUrl + arch.replace('.txt.gz', '/thread.html')). \
-                    replace('\n', ' ').replace('\r', ' ')
-            except:
-                archive_list = None
-
-        mailarch_url = BaseUrl + arch
-        mailnum = 0
-        thread_replies_is = []
-        if not clear_cached_files:
-            if filters is None:
-                filters = make_filters(args[1:], threaded_search)
-            newmsgs = mbox_messages_matching(mailarch_url, filters)
-            for message in newmsgs:
-                found_message = True
-                subj = message['subject']
-                if subj is None:
-                    continue
-                subj = subj.replace('\r', ' ').replace('\n', ' '). \
-                    replace('\t', '')
-                print "%s (%s) %s" % (message['from'], subj, message['date'])
-                match = None
-                if 'PATCH' in subj:
-                    match = __patch_id.match(subj)
-                    if match:
-                        mailnum = int(match.group('patch_num'))
-                if individual_files:
-                    mbx = mailbox.mbox('%s/%04d-%s.mbox' %
-                                       (mbx_dir, mailnum,
-                                        conv_subj(subj, match)))
-                if mbx is not None:
-                    mbx.add(message)
-
-                if individual_files and mbx is not None:
-                    mbx.close()
-                    mbx = None
-                if exec_arg:
-                    p = subprocess.Popen(exec_arg, stdin=subprocess.PIPE)
-                    p.communicate(input=str(message))
-                    p.stdin.close()
-                    p.wait()
-
-                mailnum += 1
-                if find_mailman_url and archive_list:
-                    print " * Searching URLs at %s" % \
-                        BaseUrl + arch.replace('.txt.gz', '/thread.html')
-
-                    # first, try for mhonarc
-                    subj_find = '<(a|A) (name|NAME)="([0-9]*)" (href|HREF)="(msg[0-9]*).html">' + subj.replace('[', '\\[').replace(']', '\\]') + "</(a|A)>(</(strong|STRONG)>),? ?(<(em|EM)>)?(" + message['from'] + ")?(</(em|EM)>)? ?<?/?(ul|li|UL|LI)?"
-                    re_matches = re.finditer(subj_find, archive_list)
-                    matches = list(re_matches)
-                    if len(matches) == 0:
-                        print " * Possibly pipermail"
-                        subj_find = '<LI><A HREF="([0-9]*.html)">' + \
-                            subj.replace('[', '\\[').replace(']', '\\]')
-                        re_matches = re.finditer(subj_find, archive_list)
-                        matches = list(re_matches)
-
-                    for match in matches:
-                        msgurl_match = re.search('(msg)?[0-9]*.html',
-                                                 match.string[match.start():
-                                                              match.end()])
-                        if msgurl_match:
-                            msgurl = msgurl_match.string[msgurl_match.start():
-                                                         msgurl_match.end()]
-                        else:
-                            msgurl = match.group(0)
-                        print " *** %s" % \
-                            BaseUrl + arch.replace('.txt.gz', '/') + msgurl
-                    print " * Done."
-                if dump_msgs:
-                    print message
-                if match_total != -1:
-                    match_total -= 1
-                    if match_total <= 0:
-                        sys.exit(0)
+    listed = list(ordered_map(lambda BaseUrl: (BaseUrl,
+                                               mailman_archives(BaseUrl)),
+                              BaseUrls, jobs))
+    if command == 'sync':
+        # the newest archive is the one still being written to
+        synced = True
+        for BaseUrl, archives in listed:
+            if not archives or not sync_archive(BaseUrl + archives[0]):
+                synced = False
+        sys.exit(0 if synced else 1)
+
+    if command == 'report':
+        words = report_words(args[1:])
+        measure = 'messages'
+        if words and words[0] in REPORT_MEASURES:
+            measure = words.pop(0)
+        if words and words[0] == 'by':
+            words.pop(0)
+        if [key for key in words if key not in REPORT_KEYS]:
+            usage()
+            sys.exit(1)
+        if numpy is None:
+            print "Error: the report command needs the numpy module"
+            sys.exit(1)
+        columns = archive_columns(merge_archive_lists(listed), jobs)
+        if columns is None:
+            print "No archives found"
+            sys.exit(1)
+        header, table = list_report(columns, measure, words, top)
+        print_list_report(header, table, output_format)
+        sys.exit(0)
+
+    archives = merge_archive_lists(listed)
+    if use_terms and len(args) == 1 and batch_file is None and \
+       not clear_cached_files:
+        # no filters: just bring the term index of every archive up to date
+        for indexed in ordered_map(lambda item: scan_archive(item[0], item[1],
+                                                             None, False,
+                                                             True, True),
+                                   archives, jobs):
+            pass
+        sys.exit(0)
+
+    if not clear_cached_files:
+        if batch_file is not None:
+            if threaded_search or len(args) > 1:
+                print "Error: --batch takes its filters from the batch file"
+                sys.exit(1)
+            if mbx is not None and mbx_dir is None:
+                print "Error: --batch needs -o to name a directory"
+                sys.exit(1)
+            filters = batch_filter(read_batch_file(batch_file))
         else:
-            delfile = cached_url_filename(mailarch_url)
-            print "Removing [%s]" % delfile
-            if os.path.exists(delfile):
-                os.remove(delfile)
+            filters = make_filters(args[1:], threaded_search)
+        bounds = filters.date_bounds()
+        archives = [(BaseUrl, arch) for BaseUrl, arch in archives
+                    if archive_may_match(arch, bounds)]
+        cached_only = False
+        if threaded_search:
+            # a reply may arrive months before or after the message that
+            # matched, so link every archive into the thread graph first and
+            # only then pick out the members of matching threads
+            for arch, url_map, linked in \
+                    ordered_scan(lambda item: scan_archive(item[0], item[1],
+                                                           filters),
+                                 archives, jobs):
+                for message in linked:
+                    pass
+            # archives that could not be fetched were reported already
+            archives = [(BaseUrl, arch) for BaseUrl, arch in archives
+                        if os.path.exists(cached_url_filename(BaseUrl +
+                                                              arch))]
+            filters = filters.thread_filter()
+            cached_only = True
+        if checkpoint is not None:
+            batch_text = None
+            if batch_file is not None:
+                with open(batch_file, 'r') as fileop:
+                    batch_text = fileop.read()
+            # a new reply can pull old messages into a matching thread, so
+            # threaded searches look at everything again and only skip what
+            # was reported before
+            run_checkpoint.enable(checkpoint, [','.join(BaseUrls), args[1:],
+                                               threaded_search, batch_text],
+                                  not threaded_search)
+        scanned = ordered_scan(lambda item: (item[0],) +
+                               scan_archive(item[0], item[1], filters,
+                                            find_mailman_url, False,
+                                            use_terms, cached_only),
+                               archives, jobs)
+        if exec_arg and (exec_workers or exec_framing):
+            exec_stream = exec_pool(exec_arg, max(exec_workers, 1),
+                                    exec_framing or 'mbox')
+    else:
+        scanned = ((BaseUrl, arch, None, None) for BaseUrl, arch in archives)
+
+    query_matches = {}
+    reported = set()
+    try:
+        for BaseUrl, arch, url_map, newmsgs in scanned:
+            mailarch_url = BaseUrl + arch
+            mailnum = 0
+            thread_replies_is = []
+            if not clear_cached_files:
+                for message in newmsgs:
+                    started = time.time()
+                    query = None
+                    if batch_file is not None:
+                        query, message = message
+                        if match_total != -1 and \
+                           query_matches.get(query, 0) >= match_total:
+                            # found by a worker before the query was done
+                            continue
+                    if run_checkpoint.reported(mailarch_url, message, query):
+                        continue
+                    if len(BaseUrls) > 1:
+                        # a message sent to several of the lists is only
+                        # reported for the first of them
+                        key = (query, thread_key(message_fields(message)))
+                        if key in reported:
+                            continue
+                        reported.add(key)
+                    found_message = True
+                    subj = message['subject']
+                    if subj is None:
+                        continue
+                    subj = subj.replace('\r', ' ').replace('\n', ' '). \
+                        replace('\t', '')
+                    if query is not None and not jsonl:
+                        print "[%s]" % query,
+                    if not jsonl:
+                        print "%s (%s) %s" % (message['from'], subj,
+                                              message['date'])
+                    match = None
+                    if 'PATCH' in subj:
+                        match = __patch_id.match(subj)
+                        if match:
+                            mailnum = int(match.group('patch_num'))
+                    if query is not None and mbx is not None:
+                        mbx.add('%s/%s.mbox' % (mbx_dir, query), message)
+                    elif individual_files:
+                        mbx.add('%s/%04d-%s.mbox' % (mbx_dir, mailnum,
+                                                     conv_subj(subj, match)),
+                                message)
+                    elif mbx is not None:
+                        mbx.add(mbx_path, message)
+                    if exec_stream is not None:
+                        exec_stream.add(message)
+                    elif exec_arg:
+                        p = subprocess.Popen(exec_arg, stdin=subprocess.PIPE)
+                        p.communicate(input=str(message))
+                        p.stdin.close()
+                        p.wait()
+
+                    mailnum += 1
+                    if jsonl:
+                        urls = None
+                        if find_mailman_url and url_map:
+                            urls = [BaseUrl + arch.replace('.txt.gz', '/') +
+                                    msgurl for msgurl in
+                                    message_urls(url_map, message)]
+                        print match_record(BaseUrl, arch, message, subj,
+                                           query, urls)
+                    elif find_mailman_url and url_map:
+                        print " * Searching URLs at %s" % \
+                            BaseUrl + arch.replace('.txt.gz', '/thread.html')
+                        if url_map['kind'] == 'pipermail':
+                            print " * Possibly pipermail"
+                        for msgurl in message_urls(url_map, message):
+                            print " *** %s" % \
+                                BaseUrl + arch.replace('.txt.gz', '/') + msgurl
+                        print " * Done."
+                    if dump_msgs:
+                        print message
+                    run_stats.add('output', time.time() - started, 0, 1,
+                                  arch)
+                    if match_total != -1 and query is not None:
+                        # in a batch the limit applies to every query on
+                        # its own
+                        query_matches[query] = query_matches.get(query, 0) + 1
+                        if query_matches[query] >= match_total:
+                            filters.finish(query)
+                            if filters.finished():
+                                scanned.close()
+                                sys.exit(0)
+                    elif match_total != -1:
+                        match_total -= 1
+                        if match_total <= 0:
+                            scanned.close()
+                            sys.exit(0)
+                run_checkpoint.delivered(mailarch_url)
+            else:
+                delfile = cached_url_filename(mailarch_url)
+                print "Removing [%s]" % delfile
+                remove_cache_entry(delfile)
+                remove_cache_entry(cached_url_filename(
+                    mailarch_url.replace('.txt.gz', '/thread.html')))
+    finally:
+        # matches still held in the output batches, or queued for the exec
+        # command, must be delivered on every way out, including -m and ^C
+        if mbx is not None:
+            mbx.close()
+        if exec_stream is not None:
+            exec_stream.close()
+        run_checkpoint.save()
 
     if found_message:
         sys.exit(0)
@@ -660,3 +3681,6 @@ if __name__ == "__main__":
         run_main()
     except KeyboardInterrupt:
         print("Stopped.")
+    finally:
+        run_stats.finish()
+        close_cache()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Local stand-in for a pipermail web server, serving the tree written by
+# make_archives.py.  It answers If-Modified-Since with 304 Not Modified
+# when the file did not change, honours single byte Range requests, keeps
+# connections alive and counts the requests and bytes it served.
+#
+# Usage: archive_server.py [-p PORT] DIR
+
+import BaseHTTPServer
+import SocketServer
+import email.utils
+import getopt
+import os
+import re
+import sys
+import threading
+import urllib
+
+RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class archive_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # one write per response, so small replies are not held back by Nagle
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, headers, body=''):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.server.count(code, len(body))
+
+    def do_GET(self):
+        path = urllib.unquote(self.path.split('?', 1)[0])
+        path = os.path.normpath(path).lstrip('/')
+        path = os.path.join(self.server.root, path)
+        if os.path.isdir(path):
+            path = os.path.join(path, 'index.html')
+        if not os.path.isfile(path):
+            self.reply(404, [('Content-Type', 'text/plain')], 'Not found\n')
+            return
+
+        mtime = int(os.path.getmtime(path))
+        headers = [('Last-Modified', email.utils.formatdate(mtime,
+                                                            usegmt=True))]
+        since = self.headers.getheader('If-Modified-Since')
+        if since:
+            parsed = email.utils.parsedate_tz(since)
+            if parsed is not None and email.utils.mktime_tz(parsed) >= mtime:
+                self.reply(304, headers)
+                return
+
+        with open(path, 'rb') as fileop:
+            data = fileop.read()
+        if path.endswith('.html'):
+            headers.append(('Content-Type', 'text/html'))
+        else:
+            headers.append(('Content-Type', 'application/octet-stream'))
+
+        match = RANGE_RE.match(self.headers.getheader('Range') or '')
+        if match is None:
+            self.reply(200, headers, data)
+            return
+        start = int(match.group(1))
+        end = len(data) - 1
+        if match.group(2):
+            end = min(int(match.group(2)), end)
+        if start >= len(data) or start > end:
+            self.reply(416, [('Content-Range', 'bytes */%d' % len(data))])
+            return
+        headers.append(('Content-Range',
+                        'bytes %d-%d/%d' % (start, end, len(data))))
+        self.reply(206, headers, data[start:end + 1])
+
+    do_HEAD = do_GET
+
+
+class archive_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           archive_handler)
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], path)
+
+    def count(self, code, nbytes):
+        with self._lock:
+            self._requests[code] = self._requests.get(code, 0) + 1
+            self._bytes += nbytes
+
+    def reset(self):
+        with self._lock:
+            self._requests = {}
+            self._bytes = 0
+
+    def counters(self):
+        with self._lock:
+            return {'requests': sum(self._requests.values()),
+                    'status': dict((str(code), count) for code, count
+                                   in self._requests.iteritems()),
+                    'bytes': self._bytes}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main():
+    port = 8000
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'p:h')
+    except getopt.GetoptError:
+        optlist, args = [('-h', '')], []
+    for opt, value in optlist:
+        if opt == '-p':
+            port = int(value)
+        elif opt == '-h':
+            args = []
+    if len(args) != 1:
+        print "Usage: %s [-p PORT] DIR" % sys.argv[0]
+        sys.exit(1)
+
+    server = archive_server(args[0], port)
+    print "Serving %s on %s" % (server.root, server.url())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print server.counters()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for the filter engine: evaluates a set of filter
+# expressions over every message of one cached archive three times: through
+# the filter tree's does_match() with the re.findall() matching it had
+# before the filters were compiled, through does_match() as it is now, and
+# through the compiled evaluator.
+#
+# Usage: bench_filters.py [CACHED_ARCHIVE]
+#
+# Without an argument a synthetic archive is generated.
+
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import SearchMailman
+
+QUERIES = [
+    ['from', 'contains', 'phil'],
+    ['subject', 'contains', 'PATCH', 'from', 'contains', 'redhat'],
+    ['body', 'contains', 'Signed-off-by: [A-Z]', 'subject', 'contains', 'v2'],
+    ['subject', 'contains', 'PATCH', 'or', 'body', 'contains', 'foo',
+     'body', 'contains', 'bar', 'body', 'contains', 'baz'],
+    ['subject', 'is', 'setting user mode'],
+]
+
+
+def findall_part_match(self, part_text):
+    # match_filter.part_match as it was before the regexes were compiled
+    matching_type = None
+    unmatched = SearchMailman.match_filter.MATCH_TYPE_UNMATCHED
+
+    if part_text is not None and part_text == self._match_data:
+        matching_type = SearchMailman.match_filter.MATCH_TYPE_EXACT
+    elif self._match_regex and self._match_data is not None and \
+            part_text is not None:
+        result = re.findall(self._match_data, part_text)
+        if result is not None and len(result) > 0:
+            matching_type = SearchMailman.match_filter.MATCH_TYPE_REGEX
+
+    if part_text is not None and matching_type is None and \
+       self._match_data in part_text:
+        matching_type = SearchMailman.match_filter.MATCH_TYPE_PARTIAL
+
+    if self._match_type == SearchMailman.match_filter.REQUIRED_MATCH:
+        if matching_type != SearchMailman.match_filter.MATCH_TYPE_EXACT:
+            matching_type = None
+
+    if matching_type is None:
+        matching_type = unmatched
+
+    if self._match_type == SearchMailman.match_filter.REQUIRED_NOT_MATCH:
+        if matching_type is unmatched:
+            return SearchMailman.match_filter.MATCH_TYPE_EXACT
+
+    return matching_type
+
+
+def tree_hits(tree, messages):
+    unmatched = SearchMailman.match_filter.MATCH_TYPE_UNMATCHED
+    return len([m for m in messages if tree.does_match(m) != unmatched])
+
+
+def findall_hits(tree, messages):
+    compiled = SearchMailman.match_filter.part_match
+    SearchMailman.match_filter.part_match = findall_part_match
+    try:
+        return tree_hits(tree, messages)
+    finally:
+        SearchMailman.match_filter.part_match = compiled
+
+
+def synthetic_archive(count):
+    fileop = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+    for num in xrange(count):
+        who = ['phil', 'andy', 'aaron', 'bob'][num % 4]
+        fileop.write('From %s at redhat.com  Mon Aug  5 10:00:00 2019\n'
+                     'From: %s at redhat.com (%s)\n'
+                     'Date: Mon, 05 Aug 2019 10:00:00 -0000\n'
+                     'Subject: [PATCH v%d %d/3] net: fix thing %d\n'
+                     'Message-ID: <%d@example.com>\n\n' %
+                     (who, who, who.title(), num % 3, num % 3 + 1, num, num))
+        fileop.write('This changes thing %d.\n\n' % num * 20)
+        fileop.write('Signed-off-by: %s <%s@redhat.com>\n\n' %
+                     (who.title(), who))
+    fileop.close()
+    return fileop.name
+
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        path = synthetic_archive(20000)
+
+    mbx = SearchMailman.mmappedMbox(path)
+    messages = list(mbx.itermessages())
+    for message in messages:
+        message.message()
+    print "%d messages from %s" % (len(messages), path)
+
+    fields = SearchMailman.message_fields
+    for query in QUERIES:
+        tree = SearchMailman.make_filters(query)
+        evaluate = tree.evaluator()
+        findall_time, findall_found = timed(
+            lambda: findall_hits(tree, messages))
+        tree_time, tree_found = timed(lambda: tree_hits(tree, messages))
+        compiled_time, compiled_found = timed(
+            lambda: len([m for m in messages if evaluate(fields(m))]))
+        print "%-48s findall %7.3fs tree %7.3fs compiled %7.3fs x%5.1f " \
+            "(%d/%d/%d hits)" % \
+            (' '.join(query)[:48], findall_time, tree_time, compiled_time,
+             findall_time / max(compiled_time, 1e-9), findall_found,
+             tree_found, compiled_found)
+
+    if len(sys.argv) <= 1:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
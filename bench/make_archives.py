@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+# Generates a synthetic pipermail list: an index.html listing page, one
+# YYYY-Month.txt.gz archive and YYYY-Month/thread.html page per month.
+# The output only depends on the options, so two runs with the same
+# options produce the same archives.
+#
+# Usage: make_archives.py [OPTIONS] DIR
+#
+#  -l [NAME]     List name, the archives go to DIR/pipermail/NAME (bench)
+#  -m [NUM]      Number of monthly archives (12)
+#  -n [NUM]      Messages per month (500)
+#  -b [NUM]      Body lines per message (40)
+#  -x [PERCENT]  Share of multipart MIME messages (20)
+#  -t [NUM]      Replies per thread (4)
+#  -s [NUM]      Random seed (1)
+
+import calendar
+import email.utils
+import getopt
+import gzip
+import os
+import random
+import sys
+import time
+
+START_YEAR = 2019
+
+MONTH_NAMES = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+               'August', 'September', 'October', 'November', 'December']
+
+SENDERS = ['phil', 'andy', 'aaron', 'bob', 'carol', 'dave', 'erin', 'frank']
+SUBSYSTEMS = ['net', 'mm', 'sched', 'vfs', 'ovs', 'dpif', 'ofproto', 'lib']
+WORDS = ['the', 'a', 'patch', 'fixes', 'flow', 'table', 'when', 'port',
+         'packet', 'bridge', 'this', 'change', 'user', 'mode', 'setting',
+         'kernel', 'datapath', 'should', 'not', 'leak', 'memory', 'on',
+         'error', 'path', 'we', 'need', 'to', 'check', 'return', 'value',
+         'of', 'function', 'test', 'case', 'added', 'for', 'regression']
+
+
+def body_lines(rand, count):
+    lines = []
+    for num in xrange(count):
+        if num % 10 == 9:
+            lines.append('+    ret = %s_%s(%s);' %
+                         (rand.choice(SUBSYSTEMS), rand.choice(WORDS),
+                          rand.choice(WORDS)))
+        else:
+            lines.append(' '.join(rand.choice(WORDS)
+                                  for word in xrange(rand.randint(4, 12))))
+    return '\n'.join(lines) + '\n'
+
+
+def mime_body(rand, text, boundary):
+    # alternate between the shapes lists actually get: a plain text part
+    # with a base64 patch, and quoted-printable text with an html copy
+    if rand.random() < 0.5:
+        patch = 'diff --git a/lib/%s.c b/lib/%s.c\n' % \
+            (rand.choice(WORDS), rand.choice(WORDS)) + text
+        return ('Content-Type: multipart/mixed; boundary="%s"\n' % boundary,
+                '--%s\nContent-Type: text/plain; charset="us-ascii"\n\n%s\n'
+                '--%s\nContent-Type: text/x-patch; charset="utf-8"\n'
+                'Content-Transfer-Encoding: base64\n\n%s\n--%s--\n' %
+                (boundary, text.split('\n', 1)[0], boundary,
+                 patch.encode('base64'), boundary))
+    quoted = text.replace('=', '=3D').replace(' the ', ' the=\n ')
+    return ('Content-Type: multipart/alternative; boundary="%s"\n' % boundary,
+            '--%s\nContent-Type: text/plain; charset="iso-8859-1"\n'
+            'Content-Transfer-Encoding: quoted-printable\n\n%s\n'
+            '--%s\nContent-Type: text/html; charset="iso-8859-1"\n\n'
+            '<html><body><pre>%s</pre></body></html>\n--%s--\n' %
+            (boundary, quoted, boundary, text, boundary))
+
+
+def month_archive(rand, year, month, options, first):
+    messages = []
+    links = []
+    days = calendar.monthrange(year, month)[1]
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    step = days * 24 * 60 * 60 / float(options['messages'] + 1)
+    thread = []
+    for num in xrange(options['messages']):
+        serial = first + num
+        sender = rand.choice(SENDERS)
+        stamp = start + int(step * (num + 1))
+        if not thread or len(thread) > options['depth']:
+            subject = '[PATCH v%d %d/%d] %s: %s %s' % \
+                (rand.randint(1, 3), rand.randint(1, 3), 3,
+                 rand.choice(SUBSYSTEMS), rand.choice(WORDS),
+                 rand.choice(WORDS))
+            thread = [(serial, subject)]
+            headers = ''
+        else:
+            subject = 'Re: ' + thread[0][1]
+            headers = 'In-Reply-To: <%d@bench.example.com>\n' \
+                'References: %s\n' % \
+                (thread[-1][0], ' '.join('<%d@bench.example.com>' % parent
+                                          for parent, title in thread))
+            thread.append((serial, subject))
+
+        text = body_lines(rand, options['lines'])
+        text += '\nSigned-off-by: %s <%s at example.com>\n' % \
+            (sender.title(), sender)
+        if rand.random() * 100 < options['mime']:
+            content_type, text = mime_body(rand, text, '===%d==' % serial)
+            headers += 'MIME-Version: 1.0\n' + content_type
+        else:
+            text = text.replace('\nFrom ', '\n>From ')
+
+        messages.append('From %s at example.com  %s\n'
+                        'From: %s at example.com (%s)\n'
+                        'Date: %s\n'
+                        'Subject: %s\n'
+                        'Message-ID: <%d@bench.example.com>\n%s\n%s\n' %
+                        (sender, time.asctime(time.gmtime(stamp)), sender,
+                         sender.title(), email.utils.formatdate(stamp),
+                         subject, serial, headers, text))
+        links.append('<LI><A HREF="%06d.html">%s\n</A><A NAME="%d">&nbsp;'
+                     '</A>\n<I>%s\n</I>' % (serial, subject, serial,
+                                           sender.title()))
+    return ''.join(messages), links
+
+
+def write_file(path, data, stamp):
+    fileop = open(path, 'wb')
+    fileop.write(data)
+    fileop.close()
+    os.utime(path, (stamp, stamp))
+
+
+def make_archives(root, options):
+    rand = random.Random(options['seed'])
+    listdir = os.path.join(root, 'pipermail', options['list'])
+    if not os.path.isdir(listdir):
+        os.makedirs(listdir)
+
+    rows = []
+    first = 1
+    for num in xrange(options['months']):
+        year, month = START_YEAR + num // 12, num % 12 + 1
+        name = '%d-%s' % (year, MONTH_NAMES[month - 1])
+        stamp = calendar.timegm((year + month // 12, month % 12 + 1, 1,
+                                 0, 0, 0))
+        text, links = month_archive(rand, year, month, options, first)
+        first += options['messages']
+
+        path = os.path.join(listdir, name + '.txt.gz')
+        # a fixed gzip header mtime keeps the archives byte for byte stable
+        fileop = open(path, 'wb')
+        writer = gzip.GzipFile(filename='', fileobj=fileop, mode='wb',
+                               mtime=stamp)
+        writer.write(text)
+        writer.close()
+        fileop.close()
+        os.utime(path, (stamp, stamp))
+
+        if not os.path.isdir(os.path.join(listdir, name)):
+            os.mkdir(os.path.join(listdir, name))
+        write_file(os.path.join(listdir, name, 'thread.html'),
+                   '<html><body><ul>\n%s\n</ul></body></html>\n' %
+                   '\n'.join(links), stamp)
+        rows.insert(0, '<tr><td>%s %d:</td>'
+                    '<td><A href="%s/thread.html">[ Thread ]</a></td>'
+                    '<td><A href="%s.txt.gz">[ Gzip\'d Text %d KB ]</a></td>'
+                    '</tr>' % (MONTH_NAMES[month - 1], year, name, name,
+                               os.path.getsize(path) // 1024))
+
+    write_file(os.path.join(listdir, 'index.html'),
+               '<html><body><table>\n%s\n</table></body></html>\n' %
+               '\n'.join(rows), stamp)
+    return listdir
+
+
+def usage():
+    print "Usage: %s [OPTIONS] DIR" % sys.argv[0]
+    print " -l [NAME]     List name (bench)"
+    print " -m [NUM]      Number of monthly archives (12)"
+    print " -n [NUM]      Messages per month (500)"
+    print " -b [NUM]      Body lines per message (40)"
+    print " -x [PERCENT]  Share of multipart MIME messages (20)"
+    print " -t [NUM]      Replies per thread (4)"
+    print " -s [NUM]      Random seed (1)"
+
+
+def main():
+    options = {'list': 'bench', 'months': 12, 'messages': 500, 'lines': 40,
+               'mime': 20, 'depth': 4, 'seed': 1}
+    flags = {'-l': 'list', '-m': 'months', '-n': 'messages', '-b': 'lines',
+             '-x': 'mime', '-t': 'depth', '-s': 'seed'}
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'l:m:n:b:x:t:s:h')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    for opt, value in optlist:
+        if opt == '-h':
+            usage()
+            sys.exit(0)
+        if flags[opt] == 'list':
+            options['list'] = value
+        else:
+            options[flags[opt]] = int(value)
+    if len(args) != 1:
+        usage()
+        sys.exit(1)
+
+    print make_archives(args[0], options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#
+# End to end benchmark: generates a synthetic list with make_archives.py,
+# serves it with archive_server.py and runs SearchMailman.py against it for
+# a set of common filter shapes, in three scenarios:
+#
+#  cold     empty cache, every archive is downloaded
+#  warm     the cache from the cold run, the server answers 304
+#  offline  the same cache with the server gone
+#
+# Every run is a separate process started with --stats-json, and the best
+# of the repeats is written to a JSON results file.  Two results files can
+# be compared with -c.
+#
+# Usage: run_scenarios.py [OPTIONS]
+#        run_scenarios.py -c OLD.json NEW.json
+#
+#  -o [PATH]     Where to write the results (bench-results.json)
+#  -r [NUM]      Repeat every run NUM times and keep the fastest (3)
+#  -g [OPTIONS]  make_archives.py options for the synthetic list
+#  -q [NAME]     Only run the named query shape (may be repeated)
+#  -s [OPTIONS]  Extra SearchMailman.py options for every run (eg: '-j 4')
+
+import getopt
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SEARCH = os.path.join(BENCH_DIR, '..', 'SearchMailman.py')
+
+sys.path.insert(0, BENCH_DIR)
+
+import archive_server
+
+RESULTS_VERSION = 1
+SCENARIOS = ('cold', 'warm', 'offline')
+STAGES = ('list', 'fetch', 'inflate', 'index', 'terms', 'match', 'output')
+
+QUERIES = [
+    ('header', [], ['from', 'contains', 'phil']),
+    ('header-exact', [], ['subject', 'is', 'no such subject']),
+    ('header-and', [], ['subject', 'contains', 'PATCH v2',
+                        'from', 'contains', 'bob']),
+    ('header-or', [], ['subject', 'contains', 'sched:', 'or',
+                       'from', 'contains', 'erin', 'from', 'contains',
+                       'dave']),
+    ('date-range', [], ['after', '2019-06-01', 'before', '2019-09-01',
+                        'from', 'contains', 'carol']),
+    ('body', [], ['body', 'contains', 'leak memory']),
+    ('body-regex', [], ['subject', 'contains', 'PATCH',
+                        'body', 'contains', r'ret = net_[a-z]+\(']),
+    ('body-index', ['--index'], ['body', 'contains', 'regression test']),
+    ('threaded', ['-t'], ['subject', 'contains', 'ovs: ', 'from',
+                          'contains', 'aaron']),
+]
+
+
+def run_search(url, cache, options, query):
+    fileop, stats_path = tempfile.mkstemp(suffix='.json')
+    os.close(fileop)
+    env = dict(os.environ)
+    env['SMA_CACHE_LOCATION'] = cache
+    command = [sys.executable, SEARCH, '--stats-json', stats_path] + \
+        options + [url] + query
+    started = time.time()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    wall = time.time() - started
+    try:
+        with open(stats_path) as statsop:
+            stats = json.load(statsop)
+    except (IOError, ValueError):
+        stats = {}
+    os.remove(stats_path)
+    return {'wall': wall,
+            'status': process.returncode,
+            'matches': len(output.splitlines()),
+            'stages': dict((stage, found['seconds']) for stage, found
+                           in stats.get('stages', {}).iteritems()),
+            'counters': stats.get('counters', {})}
+
+
+def keep_best(results, scenario, name, run):
+    best = results[scenario].get(name)
+    if best is None:
+        run['runs'] = [run['wall']]
+        results[scenario][name] = run
+        return
+    best['runs'].append(run['wall'])
+    if run['wall'] < best['wall']:
+        run['runs'] = best['runs']
+        results[scenario][name] = run
+
+
+def run_scenarios(archives, listname, queries, repeat, search_options):
+    results = dict((scenario, {}) for scenario in SCENARIOS)
+    for count in xrange(repeat):
+        workdir = tempfile.mkdtemp(prefix='sma-bench-')
+        try:
+            server = archive_server.archive_server(archives)
+            server.start()
+            url = server.url('pipermail/%s/' % listname)
+            caches = {}
+            for name, options, query in queries:
+                caches[name] = os.path.join(workdir, name)
+                os.mkdir(caches[name])
+                for scenario in ('cold', 'warm'):
+                    server.reset()
+                    run = run_search(url, caches[name],
+                                     search_options + options, query)
+                    run['server'] = server.counters()
+                    keep_best(results, scenario, name, run)
+            server.shutdown()
+            server.server_close()
+
+            for name, options, query in queries:
+                run = run_search(url, caches[name],
+                                 search_options + options, query)
+                keep_best(results, 'offline', name, run)
+        finally:
+            shutil.rmtree(workdir)
+    return results
+
+
+def print_results(results):
+    print "%-8s %-14s %8s %8s %s" % ('scenario', 'query', 'wall', 'matches',
+                                     ' '.join('%8s' % stage
+                                              for stage in STAGES))
+    for scenario in SCENARIOS:
+        for name in sorted(results['scenarios'][scenario]):
+            run = results['scenarios'][scenario][name]
+            print "%-8s %-14s %7.3fs %8d %s" % \
+                (scenario, name, run['wall'], run['matches'],
+                 ' '.join('%7.3fs' % run['stages'][stage]
+                          if stage in run['stages'] else '%8s' % '-'
+                          for stage in STAGES))
+
+
+def compare(old_path, new_path):
+    with open(old_path) as fileop:
+        old = json.load(fileop)
+    with open(new_path) as fileop:
+        new = json.load(fileop)
+    if old.get('generator') != new.get('generator'):
+        print "warning: the runs used different synthetic lists"
+
+    print "%-8s %-14s %9s %9s %7s" % ('scenario', 'query', 'old', 'new',
+                                      'ratio')
+    differ = False
+    for scenario in SCENARIOS:
+        for name in sorted(set(old['scenarios'].get(scenario, {})) &
+                           set(new['scenarios'].get(scenario, {}))):
+            before = old['scenarios'][scenario][name]
+            after = new['scenarios'][scenario][name]
+            note = ''
+            if before['matches'] != after['matches']:
+                note = ' matches %d -> %d' % (before['matches'],
+                                              after['matches'])
+                differ = True
+            print "%-8s %-14s %8.3fs %8.3fs %6.2fx%s" % \
+                (scenario, name, before['wall'], after['wall'],
+                 before['wall'] / max(after['wall'], 1e-9), note)
+    return differ
+
+
+def usage():
+    print "Usage: %s [OPTIONS]" % sys.argv[0]
+    print "       %s -c OLD.json NEW.json" % sys.argv[0]
+    print " -o [PATH]     Where to write the results (bench-results.json)"
+    print " -r [NUM]      Repeat every run NUM times and keep the fastest (3)"
+    print " -g [OPTIONS]  make_archives.py options for the synthetic list"
+    print " -q [NAME]     Only run the named query shape (may be repeated)"
+    print " -s [OPTIONS]  Extra SearchMailman.py options for every run"
+
+
+def main():
+    output = 'bench-results.json'
+    repeat = 3
+    generator = []
+    names = []
+    search_options = []
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'o:r:g:q:s:ch')
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    for opt, value in optlist:
+        if opt == '-c':
+            if len(args) != 2:
+                usage()
+                sys.exit(1)
+            sys.exit(1 if compare(args[0], args[1]) else 0)
+        elif opt == '-o':
+            output = value
+        elif opt == '-r':
+            repeat = int(value)
+        elif opt == '-g':
+            generator = shlex.split(value)
+        elif opt == '-q':
+            names.append(value)
+        elif opt == '-s':
+            search_options = shlex.split(value)
+        elif opt == '-h':
+            usage()
+            sys.exit(0)
+
+    queries = [entry for entry in QUERIES if not names or entry[0] in names]
+    archives = tempfile.mkdtemp(prefix='sma-archives-')
+    try:
+        listdir = subprocess.check_output(
+            [sys.executable, os.path.join(BENCH_DIR, 'make_archives.py')] +
+            generator + [archives]).strip()
+        results = {'version': RESULTS_VERSION,
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': platform.python_version(),
+                   'generator': generator,
+                   'search options': search_options,
+                   'repeat': repeat,
+                   'scenarios': run_scenarios(archives,
+                                              os.path.basename(listdir),
+                                              queries, repeat,
+                                              search_options)}
+    finally:
+        shutil.rmtree(archives)
+
+    with open(output, 'w') as fileop:
+        json.dump(results, fileop, indent=1, sort_keys=True)
+    print_results(results)
+    print "results written to %s" % output
+
+
+if __name__ == "__main__":
+    main()